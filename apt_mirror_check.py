@@ -1,16 +1,89 @@
 # coding: utf-8
 
+import array
+import asyncio
+import bisect
+import bz2
 import click
+import collections
+import collections.abc
+import contextlib
+import csv
+import errno
+import functools
+import gzip
+import lzma
+import mmap
 import os
 import glob
 from urllib.parse import urlparse
+import urllib.request
 import hashlib
+import heapq
+import json
+import queue
 import re
+import shutil
+import sqlite3
 import sys
+import threading
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import lz4.frame
+except ImportError:  # optional, only needed for Packages.lz4 indices
+    lz4 = None
+
+
+HASH_CHUNK_SIZE = 1024 * 1024  # bytes read per chunk, fed to every digest
+CACHE_FILE = "var/apt-mirror-check.db"  # relative to apt-mirror base_path
+SHARD_CACHE_FILE = "var/apt-mirror-check.shard-{}-of-{}.db"  # one per shard, hosts may share base_path
+QUARANTINE_DIR = "var/quarantine"  # relative to apt-mirror base_path, one subdirectory per run
+QUARANTINE_MANIFEST = "MANIFEST.jsonl"
+QUARANTINE_BATCH = 256  # files moved per manifest sync
+URL_LISTS = ("var/ALL", "var/NEW")  # every URL apt-mirror fetched, relative to base_path
+REFETCH_FORMATS = ("wget", "aria2c")
+
+# (type, FileAttr attribute, hashlib constructor), strongest first
+DIGESTS = (
+    ("SHA512", "sh512sum", hashlib.sha512),
+    ("SHA256", "sh256sum", hashlib.sha256),
+    ("MD5", "md5sum", hashlib.md5),
+)
+DIGEST_POLICIES = ("strongest", "fastest", "all")
+
+# index variants in order of preference, only the first one present in a directory is parsed
+PACKAGES_INDEX_NAMES = ("Packages", "Packages.xz", "Packages.gz", "Packages.bz2", "Packages.lz4")
+SOURCES_INDEX_NAMES = ("Sources", "Sources.xz", "Sources.gz", "Sources.bz2", "Sources.lz4")
+PACKAGE_SUFFIXES = (".deb", ".udeb", ".ddeb")  # pool files taken from Packages, debian-installer and debug ones
+
+PARSE_BLOCK_SIZE = 4 * 1024 * 1024  # bytes of an index read at once by pkg_records
+PKG_FIELD_RE = re.compile(rb"^(Filename|Size|MD5sum|SHA256|SHA512):[ \t]*(\S*)", re.MULTILINE)
+# Sources fields with their continuation lines, each of these lines is "checksum size name"
+SRC_FIELD_RE = re.compile(rb"^(Directory|Files|Checksums-Sha256|Checksums-Sha512):[ \t]*(.*(?:\n[ \t].*)*)",
+                          re.MULTILINE)
+# position in PkgRecord of the digest listed by each Sources field
+SRC_CHECKSUM_FIELDS = ((b"Files", 2), (b"Checksums-Sha256", 3), (b"Checksums-Sha512", 4))
+
+PkgRecord = collections.namedtuple("PkgRecord", "filename size md5sum sha256 sha512")
+
+# categories of BadFile
+CORRUPTED = "corrupted"  # size or checksum differs from the index
+MISSING = "missing"  # referenced by an index but not on disk
+ORPHAN = "orphan"  # in the pool but not referenced by any index, not an error
+GOOD = "ok"  # only in --format records, never a BadFile
+REPORT_FORMATS = ("text", "jsonl", "csv")
+# attr is the index entry the file was checked against, when there is one
+BadFile = collections.namedtuple("BadFile", "path category size attr", defaults=(None, None))
+
+RELEASE_NAMES = ("Release", "InRelease", "Release.gpg")
 
 
 class FileAttr(object):
+    __slots__ = ("path", "md5sum", "sh256sum", "sh512sum", "size")
+
     def __init__(self, path):
         self.path = path
         self.md5sum = ""
@@ -19,6 +92,559 @@ class FileAttr(object):
         self.size = 0
 
 
+class PackedFileAttr(object):
+    """ Read-only FileAttr for pool entries, digests are kept as raw bytes
+
+    A digest which is not valid hex is kept as given, it then never matches and
+    the file is reported as corrupted instead of the index failing to load.
+    """
+    __slots__ = ("size", "md5", "sha256", "sha512")
+
+    def __init__(self, size, md5sum, sh256sum, sh512sum):
+        self.size = size
+        self.md5 = self.pack(md5sum)
+        self.sha256 = self.pack(sh256sum)
+        self.sha512 = self.pack(sh512sum)
+
+    @staticmethod
+    def pack(checksum):
+        try:
+            return bytes.fromhex(checksum)
+        except ValueError:
+            return checksum
+
+    @staticmethod
+    def unpack(checksum):
+        return checksum.hex() if isinstance(checksum, bytes) else checksum
+
+    @property
+    def md5sum(self):
+        return self.unpack(self.md5)
+
+    @property
+    def sh256sum(self):
+        return self.unpack(self.sha256)
+
+    @property
+    def sh512sum(self):
+        return self.unpack(self.sha512)
+
+
+class PoolIndex(collections.abc.Mapping):
+    """ Maps absolute pool file paths to PackedFileAttr
+
+    Entries are stored under their path relative to pool_dir, split at the last
+    slash: each directory is kept once, with the names of its files and their attrs
+    in two sequences. Names are appended to lists as they come, and a directory is
+    sorted into tuples (the last attr added for a name wins) the first time it is
+    looked up, which then is a bisection.
+    """
+
+    def __init__(self, pool_dir, path_filter=None):
+        self.prefix = os.path.join(pool_dir, "")
+        self.dirs = {}  # relative dirname -> [names, attrs], tuples once sorted
+        self.path_filter = path_filter  # called with the absolute path, entries it rejects are not added
+
+    def add(self, relpath, attr):
+        if self.path_filter is not None and not self.path_filter(self.prefix + relpath):
+            return
+        dirname, _, name = relpath.rpartition("/")
+        entry = self.dirs.get(dirname)
+        if entry is None:
+            self.dirs[dirname] = [[name], [attr]]
+            return
+        if isinstance(entry[0], tuple):
+            entry[:] = [list(entry[0]), list(entry[1])]
+        entry[0].append(name)
+        entry[1].append(attr)
+
+    def sorted_dir(self, dirname):
+        """ The names and attrs of a directory, sorted by name and without duplicate names """
+        entry = self.dirs[dirname]
+        if not isinstance(entry[0], tuple):
+            names, attrs = entry
+            sorted_names, sorted_attrs = [], []
+            # the sort is stable, so of equal names the one added last comes last
+            for i in sorted(range(len(names)), key=names.__getitem__):
+                if sorted_names and sorted_names[-1] == names[i]:
+                    sorted_attrs[-1] = attrs[i]
+                else:
+                    sorted_names.append(names[i])
+                    sorted_attrs.append(attrs[i])
+            entry[:] = [tuple(sorted_names), tuple(sorted_attrs)]
+        return entry
+
+    def relpath(self, path):
+        if not path.startswith(self.prefix):
+            return None
+        return path[len(self.prefix):]
+
+    def lookup(self, relpath):
+        """ The attr of a path relative to pool_dir, None if there is none """
+        dirname, _, name = relpath.rpartition("/")
+        if dirname not in self.dirs:
+            return None
+        names, attrs = self.sorted_dir(dirname)
+        i = bisect.bisect_left(names, name)
+        return attrs[i] if i < len(names) and names[i] == name else None
+
+    def dir_items(self, dirname):
+        """ (absolute path, attr) of the entries of a directory, sorted by name """
+        names, attrs = self.sorted_dir(dirname)
+        dir_prefix = self.prefix + dirname + "/" if dirname else self.prefix
+        return zip([dir_prefix + name for name in names], attrs)
+
+    def sorted_items(self):
+        """ (absolute path, attr) in directory order, paths are built one directory at a time """
+        for dirname in sorted(self.dirs):
+            yield from self.dir_items(dirname)
+
+    def __getitem__(self, path):
+        relpath = self.relpath(path)
+        attr = None if relpath is None else self.lookup(relpath)
+        if attr is None:
+            raise KeyError(path)
+        return attr
+
+    def __contains__(self, path):
+        relpath = self.relpath(path)
+        return relpath is not None and self.lookup(relpath) is not None
+
+    def __iter__(self):
+        for dirname in list(self.dirs):
+            for path, _ in self.dir_items(dirname):
+                yield path
+
+    def __len__(self):
+        return sum(len(self.sorted_dir(dirname)[0]) for dirname in self.dirs)
+
+
+class PathHashSet(object):
+    """ Set of relative paths kept as a sorted array of 64 bit hashes, 8 bytes per path
+
+    A hash collision can only make an unreferenced path look referenced. The hashes
+    are sorted in runs of RUN_SIZE which are then merged, so building the set takes
+    about twice its final size rather than a Python int per path.
+    """
+
+    RUN_SIZE = 65536
+
+    def __init__(self, paths):
+        runs = []
+        run = []
+        for path in paths:
+            run.append(self.hash(path))
+            if len(run) >= self.RUN_SIZE:
+                runs.append(array.array("Q", sorted(run)))
+                run = []
+        runs.append(array.array("Q", sorted(run)))
+        del run
+
+        self.hashes = array.array("Q")
+        last = None
+        for h in heapq.merge(*runs):
+            if h != last:
+                self.hashes.append(h)
+                last = h
+
+    @staticmethod
+    def hash(path):
+        return int.from_bytes(hashlib.blake2b(path.encode(), digest_size=8).digest(), "little")
+
+    def __contains__(self, path):
+        h = self.hash(path)
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class VerifyCache(object):
+    """ Remembers files which passed verification, keyed by their stat metadata """
+
+    COMMIT_EVERY = 1000
+
+    def __init__(self, db_path, max_age=None):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verified ("
+                          "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+                          "checksum TEXT, verified_at REAL)")
+        # digests of Release files and Packages indices seen by the last clean incremental run
+        self.conn.execute("CREATE TABLE IF NOT EXISTS snapshots (path TEXT PRIMARY KEY, checksum TEXT)")
+        # an existing database may be readable only, fail now rather than at the first store()
+        self.conn.execute("DELETE FROM verified WHERE path IS NULL")
+        self.conn.commit()
+
+    def is_verified(self, filepath, stat, checksum):
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, inode, checksum, verified_at FROM verified "
+                                    "WHERE path = ?", (filepath,)).fetchone()
+        if row is None:
+            return False
+        size, mtime_ns, inode, verified_checksum, verified_at = row
+        if self.max_age is not None and time.time() - verified_at > self.max_age:
+            return False
+        return (size, mtime_ns, inode, verified_checksum) == \
+            (stat.st_size, stat.st_mtime_ns, stat.st_ino, checksum)
+
+    def store(self, filepath, stat, checksum):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?)",
+                              (filepath, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                               checksum, time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def forget(self, filepath):
+        with self.lock:
+            self.conn.execute("DELETE FROM verified WHERE path = ?", (filepath,))
+
+    def changed_paths(self, prefix, batch_size=10000):
+        """ Yields the verified paths under prefix whose file is gone or whose stat differs from when it was verified """
+        last = prefix
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)  # paths starting with prefix sort before it
+        while True:
+            with self.lock:
+                rows = self.conn.execute("SELECT path, size, mtime_ns, inode FROM verified "
+                                         "WHERE path > ? AND path < ? ORDER BY path LIMIT ?",
+                                         (last, end, batch_size)).fetchall()
+            for path, size, mtime_ns, inode in rows:
+                try:
+                    s = os.stat(path)
+                except FileNotFoundError:
+                    yield path
+                    continue
+                if (s.st_size, s.st_mtime_ns, s.st_ino) != (size, mtime_ns, inode):
+                    yield path
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def snapshot(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT checksum FROM snapshots WHERE path = ?", (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def store_snapshots(self, snapshots):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?)", snapshots)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class Stats(object):
+    """ Timing and throughput counters of a run, grouped by mirror and by dist
+
+    Time counters are seconds spent in a phase, hashing is summed over all the
+    worker threads; "seconds" is the wall clock time of a dist or pool check.
+    """
+
+    PHASES = ("discovery", "release", "packages", "hashing")
+    COUNTERS = PHASES + ("bytes_hashed", "files_checked", "files_skipped", "files_missing")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.discovery = 0.0  # finding the mirrors in base_path
+        self.mirrors = collections.OrderedDict()
+        self.section = None
+
+    def begin(self, mirror_dir, name):
+        """ Starts counting for a dist (or the pool) of a mirror, ending the previous one """
+        with self.lock:
+            self._end()
+            self.section = dict.fromkeys(self.COUNTERS, 0)
+            self.section["started"] = time.perf_counter()
+            self.mirrors.setdefault(mirror_dir, collections.OrderedDict())[name] = self.section
+
+    def end(self):
+        with self.lock:
+            self._end()
+
+    def _end(self):
+        if self.section is not None:
+            self.section["seconds"] = time.perf_counter() - self.section.pop("started")
+            self.section = None
+
+    def add(self, counter, value):
+        with self.lock:
+            if self.section is not None:
+                self.section[counter] += value
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    @staticmethod
+    def summed(sections):
+        total = dict.fromkeys(Stats.COUNTERS + ("seconds",), 0)
+        for section in sections:
+            for counter in total:
+                total[counter] += section.get(counter, 0)
+        total["mb_per_sec"] = total["bytes_hashed"] / 1024 / 1024 / total["seconds"] if total["seconds"] else 0.0
+        return total
+
+    def as_dict(self):
+        """ The counters so far, a section still running counts its time up to now """
+        now = time.perf_counter()
+        with self.lock:
+            snapshot = [(mirror_dir, collections.OrderedDict((name, dict(section)) for name, section in sections.items()))
+                        for mirror_dir, sections in self.mirrors.items()]
+        for _, sections in snapshot:
+            for section in sections.values():
+                if "started" in section:
+                    section["seconds"] = now - section.pop("started")
+
+        mirrors = []
+        for mirror_dir, sections in snapshot:
+            mirror = self.summed(sections.values())
+            mirror["mirror"] = mirror_dir
+            mirror["dists"] = []
+            for name, section in sections.items():
+                section = dict(section, name=name)
+                section.update(mb_per_sec=self.summed([section])["mb_per_sec"])
+                mirror["dists"].append(section)
+            mirrors.append(mirror)
+        total = self.summed(section for _, sections in snapshot for section in sections.values())
+        total["discovery"] += self.discovery
+        total["seconds"] = now - self.started
+        return {"mirrors": mirrors, "total": total}
+
+    def format(self):
+        def line(name, counters):
+            return "{:<40} {:>9.2f} s  discovery {:.2f} s  release {:.2f} s  packages {:.2f} s  " \
+                   "hashing {:.2f} s  checked {}  skipped {}  missing {}  hashed {:.1f} MB  {:.1f} MB/s".format(
+                       name, counters["seconds"], counters["discovery"], counters["release"],
+                       counters["packages"], counters["hashing"], counters["files_checked"],
+                       counters["files_skipped"], counters["files_missing"], counters["bytes_hashed"] / 1024 / 1024,
+                       counters["mb_per_sec"])
+
+        stats = self.as_dict()
+        lines = []
+        for mirror in stats["mirrors"]:
+            lines.append(line(mirror["mirror"], mirror))
+            for dist in mirror["dists"]:
+                lines.append(line("  " + dist["name"], dist))
+        lines.append(line("total", stats["total"]))
+        return "\n".join(lines)
+
+
+class MetricsFile(object):
+    """ Keeps an OpenMetrics textfile with the progress of a run, for node_exporter's textfile collector
+
+    The file is rewritten every interval seconds by a background thread and once more
+    at the end, each time through a temporary file renamed over it, so a scrape never
+    reads half a file. All values are gauges describing the current or last run.
+    """
+
+    PREFIX = "apt_mirror_check_"
+    RESULTS = collections.OrderedDict([
+        (CORRUPTED, "Files whose size or checksum differs from the index"),
+        (MISSING, "Files referenced by an index but not on disk"),
+        (ORPHAN, "Pool files no index refers to"),
+        ("deleted", "Corrupted files deleted by --delete"),
+        ("quarantined", "Corrupted files moved away by --quarantine"),
+    ])
+
+    def __init__(self, path, stats, interval=60.0):
+        self.path = path
+        self.stats = stats
+        self.interval = interval
+        self.results = collections.Counter()  # (mirror_dir, category) -> files
+        self.exit_code = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def count(self, mirror_dir, category):
+        self.results[mirror_dir, category] += 1
+
+    def start(self):
+        self.write()
+        self.thread = threading.Thread(target=self.run, name="metrics-file", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def finish(self, exit_code):
+        """ Stops the periodic writes and writes the final figures """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.exit_code = exit_code
+        self.write()
+
+    @staticmethod
+    def label(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def format(self):
+        stats = self.stats.as_dict()
+        metrics = collections.OrderedDict()
+
+        def add(name, help, value, mirror=None):
+            samples = metrics.setdefault(name, (help, []))[1]
+            labels = "" if mirror is None else '{mirror="%s"}' % self.label(mirror)
+            samples.append("%s%s%s %s" % (self.PREFIX, name, labels, repr(float(value))))
+
+        add("running", "1 while a run is in progress", 0 if self.exit_code is not None else 1)
+        if self.exit_code is not None:
+            add("success", "1 if the last run found no corrupted or missing file", 0 if self.exit_code else 1)
+        add("last_update_timestamp_seconds", "When this file was written", time.time())
+        add("duration_seconds", "Wall clock time of the run so far", stats["total"]["seconds"])
+        for mirror in stats["mirrors"]:
+            mirror_dir = mirror["mirror"]
+            add("mirror_duration_seconds", "Time spent checking a mirror", mirror["seconds"], mirror_dir)
+            add("files_checked", "Files stat'ed and verified", mirror["files_checked"], mirror_dir)
+            add("files_skipped", "Files found in the verification cache", mirror["files_skipped"], mirror_dir)
+            add("bytes_hashed", "Bytes read and hashed", mirror["bytes_hashed"], mirror_dir)
+            add("hashing_seconds", "Time spent hashing, summed over worker threads", mirror["hashing"], mirror_dir)
+            add("hashing_bytes_per_second", "Bytes hashed per second of the mirror check",
+                mirror["mb_per_sec"] * 1024 * 1024, mirror_dir)
+            for category, help in self.RESULTS.items():
+                add("files_" + category, help, self.results[mirror_dir, category], mirror_dir)
+
+        lines = []
+        for name, (help, samples) in metrics.items():
+            lines.append("# HELP %s%s %s" % (self.PREFIX, name, help))
+            lines.append("# TYPE %s%s gauge" % (self.PREFIX, name))
+            lines.extend(samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(self.format())
+        os.replace(tmp_path, self.path)
+
+
+class TokenBucket(object):
+    """ Thread safe rate limiter, consume() sleeps until the amount fits the rate
+
+    Consumers may take the bucket into debt and then wait it off, so amounts
+    bigger than the burst size work and concurrent callers queue up fairly.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Reporter(object):
+    """ Writes one record per checked file as JSON Lines or CSV, from any thread
+
+    Each record is flushed as soon as it is written, so a long run can be followed
+    with tail -f and nothing is kept in memory.
+    """
+
+    FIELDS = ("path", "category", "check", "expected_size", "actual_size", "digest", "expected_digest",
+              "actual_digest", "elapsed")
+
+    def __init__(self, format, stream):
+        self.format = format
+        self.stream = stream
+        self.lock = threading.Lock()
+        if format == "csv":
+            self.writer = csv.writer(stream)
+            self.writer.writerow(self.FIELDS)
+
+    def __call__(self, record):
+        with self.lock:
+            if self.format == "csv":
+                self.writer.writerow([record.get(field) for field in self.FIELDS])
+            else:
+                self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+
+
+def shard_of(relpath, count):
+    """ The shard, from 1 to count, a relative path belongs to; the same on every host """
+    return int.from_bytes(hashlib.blake2b(relpath.encode(), digest_size=8).digest(), "big") % count + 1
+
+
+class CheckOptions(object):
+    """ How files are verified, shared by all the checks of a run """
+
+    def __init__(self, jobs=1, cache=None, incremental=False, index_driven=False, orphans=False, quick=False,
+                 digest="strongest", aio=False, max_stat=64, max_read=8, mmap_threshold=0, io_hints=True,
+                 direct_io=False, read_limit=None, files_limit=None, shard=None, shard_root=None, reporter=None,
+                 stats=None):
+        self.jobs = jobs
+        self.cache = cache
+        self.incremental = incremental
+        self.index_driven = index_driven
+        self.orphans = orphans
+        self.quick = quick  # compare sizes only, never read file data
+        self.digest = digest  # one of DIGEST_POLICIES
+        # asyncio pipeline instead of jobs threads, with separate in-flight limits for stat and read
+        self.aio = aio
+        self.max_stat = max_stat
+        self.max_read = max_read
+        self.mmap_threshold = mmap_threshold  # files at least this big are hashed from a mapping, 0 disables
+        self.io_hints = io_hints  # posix_fadvise SEQUENTIAL while reading, DONTNEED once hashed
+        self.direct_io = direct_io  # O_DIRECT reads bypassing the page cache where supported
+        # TokenBucket of bytes read and of files checked, shared by all workers, None if unlimited
+        self.read_limit = read_limit
+        self.files_limit = files_limit
+        # (K, N) to check only the K-th of N disjoint slices of the files, paths are hashed relative to shard_root
+        self.shard = shard
+        self.shard_root = None if shard_root is None else os.path.join(shard_root, "")
+        self.reporter = reporter  # Reporter getting a record per file, None prints mismatches as text
+        self.stats = stats if stats is not None else Stats()
+
+    def in_shard(self, path):
+        if self.shard is None:
+            return True
+        if self.shard_root is not None and path.startswith(self.shard_root):
+            path = path[len(self.shard_root):]
+        return shard_of(path, self.shard[1]) == self.shard[0]
+
+    def report(self, filepath, category, message=None, **fields):
+        """ Prints the message about a file, or hands a record of it to the reporter """
+        if self.reporter is None:
+            if message is not None:
+                print(filepath, message)
+            return
+        record = {"path": filepath, "category": category}
+        record.update(fields)
+        if record.get("elapsed") is not None:
+            record["elapsed"] = round(record["elapsed"], 6)
+        self.reporter(record)
+
+    def echo(self, message):
+        """ Progress text, kept off stdout when it carries records """
+        click.echo(message, err=self.reporter is not None)
+
+
 def parse_release_block_title_line(line):
     if line.startswith("MD5Sum:"):
         return True, "md5sum"
@@ -61,12 +687,39 @@ def dist_attrs(dist_dir):
     return attrs
 
 
+def open_index(path, mode="rt"):
+    """ Opens a possibly compressed index file as a stream, decompressing on the fly """
+    if path.endswith(".xz"):
+        return lzma.open(path, mode)
+    elif path.endswith(".gz"):
+        return gzip.open(path, mode)
+    elif path.endswith(".bz2"):
+        return bz2.open(path, mode)
+    elif path.endswith(".lz4"):
+        if lz4 is None:
+            raise RuntimeError("lz4 module is required to read %s, install it with pip install lz4" % path)
+        return lz4.frame.open(path, mode)
+    return open(path, mode)
+
+
+def find_index(filenames, index_names):
+    """ Picks the preferred variant of an index among the files in a directory
+
+    .lz4 comes last, so it is only picked when it is the only variant; without the
+    lz4 module open_index then fails instead of the index being silently skipped.
+    """
+    for name in index_names:
+        if name in filenames:
+            return name
+    return None
+
+
 def pkg_attrs(pkg_desc_path):
     """ Opens Package file and loads it content as a attr """
-    with open(pkg_desc_path, "rt") as f:
+    with open_index(pkg_desc_path) as f:
         attrs = {}
         last_key = None
-        for line in f.readlines():
+        for line in f:
             line = line.rstrip('\n')
             if len(line.strip()) == 0:
                 yield attrs
@@ -82,84 +735,528 @@ def pkg_attrs(pkg_desc_path):
                     raise ValueError
                 last_key = line[:sep_index]
                 attrs[last_key] = line[sep_index + 2:]  # skip : and a space
+        if attrs:
+            yield attrs
 
 
-def pool_attrs(dist_dir, pool_dir):
-    """ Parse attributes in Packages file"""
-    attrs = {}
+def index_stanzas(index_path, block_size=PARSE_BLOCK_SIZE):
+    """ Streams the stanzas of a Packages or Sources file as bytes, reading large blocks """
+    with open_index(index_path, "rb") as f:
+        tail = b""
+        while True:
+            block = f.read(block_size)
+            if block:
+                data = tail + block
+                end = data.rfind(b"\n\n")
+                if end < 0:
+                    tail = data
+                    continue
+                data, tail = data[:end], data[end + 2:]
+            else:
+                data, tail = tail, b""
+
+            yield from data.split(b"\n\n")
+
+            if not block:
+                break
+
+
+def pkg_records(pkg_desc_path, block_size=PARSE_BLOCK_SIZE):
+    """ Streams the fields needed for verification out of a Packages file
+
+    Only the Filename, Size and checksum fields are extracted, everything else
+    (Description etc.) is skipped without being split into lines.
+    """
+    for stanza in index_stanzas(pkg_desc_path, block_size):
+        fields = dict(PKG_FIELD_RE.findall(stanza))
+        filename = fields.get(b"Filename")
+        if filename is None:
+            continue
+        yield PkgRecord(filename.decode(), int(fields.get(b"Size", b"0")),
+                        fields.get(b"MD5sum", b"").decode(),
+                        fields.get(b"SHA256", b"").decode(),
+                        fields.get(b"SHA512", b"").decode())
+
+
+def src_records(src_desc_path, block_size=PARSE_BLOCK_SIZE):
+    """ Streams a PkgRecord for every file (.dsc, .orig.tar.*, .debian.tar.* ...) of a Sources file
+
+    A source stanza lists its files in Directory once per checksum field, the
+    entries of Files (MD5), Checksums-Sha256 and Checksums-Sha512 are joined by name.
+    """
+    for stanza in index_stanzas(src_desc_path, block_size):
+        fields = dict(SRC_FIELD_RE.findall(stanza))
+        directory = fields.get(b"Directory", b"").strip()
+        if not directory:
+            continue
+        files = collections.OrderedDict()  # name -> [name, size, md5sum, sha256, sha512]
+        for field, position in SRC_CHECKSUM_FIELDS:
+            for line in fields.get(field, b"").splitlines():
+                entry = line.split()
+                if len(entry) != 3 or not entry[1].isdigit():
+                    continue
+                checksum, size, name = entry
+                files.setdefault(name, [name, int(size), "", "", ""])[position] = checksum.decode()
+        for name, size, md5sum, sha256, sha512 in files.values():
+            yield PkgRecord((directory + b"/" + name).decode(), size, md5sum, sha256, sha512)
+
+
+def index_files(dist_dir):
+    """ Yields (path, parser) for the preferred variant of each Packages and Sources index of a dist """
     for root, _, files in os.walk(dist_dir):
-        for filename in files:
-            if filename != "Packages":
-                continue
-            for pkgattr in pkg_attrs(os.path.join(root, filename)):
-                name = pkgattr["Filename"]
-                if name.endswith(".deb"):
-                    path = os.path.join(pool_dir, name)
-
-                    attr = FileAttr(path)
-                    attr.size = int(pkgattr.get("Size", "0"))
-                    attr.md5sum = pkgattr.get("MD5sum", "")
-                    attr.sh256sum = pkgattr.get("SHA256", "")
+        for index_names, parse in ((PACKAGES_INDEX_NAMES, pkg_records), (SOURCES_INDEX_NAMES, src_records)):
+            filename = find_index(files, index_names)
+            if filename is not None:
+                yield os.path.join(root, filename), parse
 
-                    attrs[path] = attr
+
+def pool_attrs(dist_dir, pool_dir, attrs=None, index_filter=None):
+    """ Parse attributes in Packages and Sources files, merging them into attrs if given
+
+    index_filter is called with the path of each index, those it returns False for are skipped.
+    """
+    if attrs is None:
+        attrs = PoolIndex(pool_dir)
+    for index_path, parse in index_files(dist_dir):
+        if index_filter is not None and not index_filter(index_path):
+            continue
+        for record in parse(index_path):
+            if parse is src_records or record.filename.endswith(PACKAGE_SUFFIXES):
+                attrs.add(os.path.normpath(record.filename),
+                          PackedFileAttr(record.size, record.md5sum, record.sha256, record.sha512))
     return attrs
 
 
-def is_checksum_correct(filepath, attr):
-    is_good = True
+def referenced_paths(pool_dir, dist_dirs):
+    """ Union of the paths, relative to pool_dir, which Release, Packages and Sources files of the dists refer to """
+    def relpaths():
+        for dist_dir in dist_dirs:
+            for path in dist_attrs(dist_dir):
+                yield os.path.relpath(path, pool_dir)
+            for index_path, parse in index_files(dist_dir):
+                for record in parse(index_path):
+                    yield os.path.normpath(record.filename)
+
+    return PathHashSet(relpaths())
+
+
+def orphan_files(pool_dir, scan_dir, referenced):
+    """ Yields a BadFile with its size for each file under scan_dir which is not referenced """
+    prefix = os.path.join(pool_dir, "")
+    dirs = [scan_dir]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.name not in RELEASE_NAMES and entry.path[len(prefix):] not in referenced:
+                    yield BadFile(entry.path, ORPHAN, entry.stat(follow_symlinks=False).st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def fastest_digest_order():
+    """ SHA digest types ordered by their speed on this machine, MD5 last as it is broken """
+    data = bytes(4 * 1024 * 1024)
+    timings = []
+    for hash_type, _, constructor in DIGESTS:
+        if hash_type != "MD5":
+            start = time.perf_counter()
+            constructor(data)
+            timings.append((time.perf_counter() - start, hash_type))
+    return tuple(hash_type for _, hash_type in sorted(timings)) + ("MD5",)
+
+
+def select_digests(attr, policy="strongest"):
+    """ The DIGESTS entries available in attr which a digest policy computes
+
+    strongest and fastest pick a single digest, all picks every available one.
+    """
+    available = [digest for digest in DIGESTS if getattr(attr, digest[1])]
+    if policy == "all":
+        return available
+    if policy == "fastest":
+        order = fastest_digest_order()
+        available.sort(key=lambda digest: order.index(digest[0]))
+    return available[:1]
+
+
+def checksum_key(attr, digests=DIGESTS):
+    """ The expected checksums of attr, as recorded in the cache """
+    return ";".join("%s=%s" % (hash_type, getattr(attr, name)) for hash_type, name, _ in digests
+                    if getattr(attr, name))
+
+
+def precheck_file(filepath, attr, options):
+    """ The stat stage of is_checksum_correct
+
+    Returns the verdict and the stat result, the verdict is None if the data needs hashing.
+    """
+    cache, stats = options.cache, options.stats
+    if options.files_limit is not None:
+        options.files_limit.consume(1)
+    start = time.perf_counter()
     s = os.stat(filepath)
+    stats.add("files_checked", 1)
+    # a truncated or oversized file fails without reading its data
     if attr.size != s.st_size:
-        print(filepath, "expected size: {}, but {}".format(attr.size, s.st_size))
+        options.report(filepath, CORRUPTED, "expected size: {}, but {}".format(attr.size, s.st_size), check="size",
+                       expected_size=attr.size, actual_size=s.st_size, elapsed=time.perf_counter() - start)
+        if cache is not None:
+            cache.forget(filepath)
+        return False, s
+    if options.quick:
+        options.report(filepath, GOOD, check="size", expected_size=attr.size, actual_size=s.st_size,
+                       elapsed=time.perf_counter() - start)
+        return True, s
+    if cache is not None and cache.is_verified(filepath, s, checksum_key(attr, select_digests(attr, options.digest))):
+        stats.add("files_skipped", 1)
+        options.report(filepath, GOOD, check="cache", expected_size=attr.size, actual_size=s.st_size,
+                       elapsed=time.perf_counter() - start)
+        return True, s
+    return None, s
+
+
+def is_checksum_correct(filepath, attr, options=None):
+    if options is None:
+        options = CheckOptions()
+    is_good, s = precheck_file(filepath, attr, options)
+    if is_good is None:
+        is_good = hash_file(filepath, attr, s, options)
+    return is_good
+
+
+def fadvise(fd, advice, options):
+    """ Tells the kernel how a file is used, advice names a POSIX_FADV_* constant """
+    if options.io_hints and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def direct_chunks(filepath):
+    """ Yields a file read with O_DIRECT into a page aligned buffer, returns False if the file system refuses it """
+    try:
+        fd = os.open(filepath, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno == errno.EINVAL:  # e.g. tmpfs
+            return False
+
+        raise
+
+    try:
+        # an anonymous mapping is page aligned, as O_DIRECT requires
+        with mmap.mmap(-1, HASH_CHUNK_SIZE) as buf, memoryview(buf) as view:
+            while True:
+                n = os.readv(fd, [buf])
+                if not n:
+                    break
+                with view[:n] as chunk:
+                    yield chunk
+    finally:
+        os.close(fd)
+
+    return True
+
+
+def file_chunks(filepath, size, options):
+    """ Yields the content of a file in HASH_CHUNK_SIZE pieces
+
+    Files of at least options.mmap_threshold bytes are mapped and handed out as
+    memoryview slices, so their data is not copied into bytes objects. Unless
+    options.io_hints is off, the pages read are dropped from the page cache
+    afterwards, so a full scan does not evict what the mirror is serving.
+    """
+    if options.direct_io and hasattr(os, "O_DIRECT"):
+        if (yield from direct_chunks(filepath)):
+            return
+
+    with open(filepath, "rb") as f:
+        fd = f.fileno()
+        fadvise(fd, "POSIX_FADV_SEQUENTIAL", options)
+        try:
+            # the stat size may be stale, and mmap refuses an empty file
+            if options.mmap_threshold and size >= options.mmap_threshold and os.fstat(fd).st_size:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    for offset in range(0, len(view), HASH_CHUNK_SIZE):
+                        with view[offset:offset + HASH_CHUNK_SIZE] as chunk:
+                            yield chunk
+                return
+
+            while True:
+                d = f.read(HASH_CHUNK_SIZE)
+                if not d:
+                    break
+                yield d
+        finally:
+            fadvise(fd, "POSIX_FADV_DONTNEED", options)
+
+
+def hash_file(filepath, attr, s, options):
+    """ The read stage of is_checksum_correct, s is the stat result of the file """
+    cache, stats = options.cache, options.stats
+    digests = select_digests(attr, options.digest)
+    key = checksum_key(attr, digests)
+    is_good = True
+    start = time.perf_counter()
 
     checksums = []
-    if len(attr.sh256sum) != 0:
+    for hash_type, name, constructor in digests:
         checksums.append( {
-            "m": hashlib.sha256(),
-            "expected_checksum": attr.sh256sum,
-            "type": "SHA256",
-        } )
-    if len(attr.sh512sum) != 0:
-        checksums.append( {
-            "m": hashlib.sha512(),
-            "expected_checksum": attr.sh512sum,
-            "type": "SHA512",
-        } )
-    if len(attr.md5sum) != 0:
-        checksums.append( {
-            "m": hashlib.md5(),
-            "expected_checksum": attr.md5sum,
-            "type": "MD5",
+            "m": constructor(),
+            "expected_checksum": getattr(attr, name),
+            "type": hash_type,
         } )
 
-    data = bytearray()
-    with open(filepath, "rb") as f:
-        while True:
-            d = f.read(1024 * 1024)
-            if not d:
+    # without any digest precheck_file already compared the size and there is nothing to read;
+    # time spent waiting on --read-limit is not hashing, so it stays out of the timed block
+    chunks = file_chunks(filepath, s.st_size, options) if checksums else iter(())
+    while True:
+        with stats.timed("hashing"):
+            d = next(chunks, None)
+            if d is None:
                 break
-            data += d
+            for checksum in checksums:
+                checksum['m'].update(d)
+            stats.add("bytes_hashed", len(d))
+        if options.read_limit is not None:
+            options.read_limit.consume(len(d))
 
+    mismatch = None
     for checksum in checksums:
-        checksum['m'].update(data)
         real_checksum = checksum['m'].hexdigest()
         hash_type, expected_checksum = checksum['type'], checksum['expected_checksum']
+        checksum['real_checksum'] = real_checksum
 
         if real_checksum != expected_checksum:
-            print(filepath, f"expected {hash_type} checksum: {expected_checksum}, but {real_checksum}")
+            if options.reporter is None:
+                print(filepath, f"expected {hash_type} checksum: {expected_checksum}, but {real_checksum}")
+            mismatch = mismatch or checksum
             is_good = False
 
+    if options.reporter is not None:
+        if not checksums:
+            # the index gives no digest, only the size was compared
+            options.report(filepath, GOOD, check="size", expected_size=attr.size, actual_size=s.st_size,
+                           digest=None, elapsed=time.perf_counter() - start)
+        else:
+            # the first mismatching digest, or the first one computed
+            checksum = mismatch or checksums[0]
+            options.report(filepath, GOOD if is_good else CORRUPTED, check="hash", expected_size=attr.size,
+                           actual_size=s.st_size, digest=checksum['type'],
+                           expected_digest=checksum['expected_checksum'], actual_digest=checksum['real_checksum'],
+                           elapsed=time.perf_counter() - start)
+
+    if cache is not None:
+        if is_good:
+            cache.store(filepath, s, key)
+        else:
+            cache.forget(filepath)
+
     return is_good
 
 
-def bad_files_in_dir(dirpath, attrs):
-    for root, _, files in os.walk(dirpath):
-        for filename in files:
-            if filename == "Release":
-               continue
-            filepath = os.path.join(root, filename)
-            if filepath in attrs:
-                if not is_checksum_correct(filepath, attrs[filepath]):
-                    yield filepath
+def check_file(filepath, attr, options):
+    """ Returns the BadFile category of a file, None if it is good """
+    try:
+        if is_checksum_correct(filepath, attr, options):
+            return None
+        return CORRUPTED
+    except FileNotFoundError:
+        options.stats.add("files_missing", 1)
+        options.report(filepath, MISSING, check="stat", expected_size=attr.size)
+        return MISSING
+
+
+async def check_pipeline(candidates, options, results, stop):
+    """ Checks (filepath, attr) pairs, putting a BadFile in results for each bad one
+
+    Discovery, stat and read/hash each run on executor threads, so slow storage
+    keeps up to max_stat stats and max_read reads in flight at the same time.
+    """
+    loop = asyncio.get_running_loop()
+    stat_limit = asyncio.Semaphore(options.max_stat)
+    read_limit = asyncio.Semaphore(options.max_read)
+    # bounds the number of files between discovery and report
+    in_flight = asyncio.Semaphore(options.max_stat + options.max_read)
+    tasks, errors = set(), []
+
+    def done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    with ThreadPoolExecutor(max_workers=1) as discovery, \
+            ThreadPoolExecutor(max_workers=options.max_stat + options.max_read) as executor:
+
+        async def check(filepath, attr):
+            try:
+                try:
+                    async with stat_limit:
+                        is_good, s = await loop.run_in_executor(executor, precheck_file, filepath, attr, options)
+                    if is_good is None:
+                        async with read_limit:
+                            is_good = await loop.run_in_executor(executor, hash_file, filepath, attr, s, options)
+                    category = None if is_good else CORRUPTED
+                except FileNotFoundError:
+                    options.stats.add("files_missing", 1)
+                    options.report(filepath, MISSING, check="stat", expected_size=attr.size)
+                    category = MISSING
+                if category is not None:
+                    results.put(BadFile(filepath, category, attr=attr))
+            finally:
+                in_flight.release()
+
+        candidates = iter(candidates)
+        while not stop.is_set() and not errors:
+            item = await loop.run_in_executor(discovery, next, candidates, None)
+            if item is None:
+                break
+            await in_flight.acquire()
+            task = asyncio.ensure_future(check(*item))
+            tasks.add(task)
+            task.add_done_callback(done)
+        while tasks:
+            await asyncio.wait(set(tasks))
+    if errors:
+        raise errors[0]
+
+
+def bad_files_async(candidates, options):
+    """ Runs check_pipeline on an event loop thread, yielding BadFiles as soon as they are found """
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def run():
+        try:
+            asyncio.run(check_pipeline(candidates, options, results, stop))
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    thread = threading.Thread(target=run, name="check-pipeline", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def bad_files(candidates, options=None):
+    """ Check (filepath, attr) pairs, yield a BadFile for each bad one in input order
+
+    With options.aio the order is the order in which the checks complete.
+    """
+    if options is None:
+        options = CheckOptions()
+    if options.aio:
+        yield from bad_files_async(candidates, options)
+        return
+    jobs = options.jobs
+    if jobs <= 1:
+        for filepath, attr in candidates:
+            category = check_file(filepath, attr, options)
+            if category is not None:
+                yield BadFile(filepath, category, attr=attr)
+        return
+
+    # hashlib releases the GIL while hashing large buffers, so threads scale;
+    # keep a bounded window of futures so huge pools are not queued at once
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for filepath, attr in candidates:
+            pending.append((filepath, attr, executor.submit(check_file, filepath, attr, options)))
+            if len(pending) >= jobs * 4:
+                filepath, attr, future = pending.popleft()
+                if future.result() is not None:
+                    yield BadFile(filepath, future.result(), attr=attr)
+        while pending:
+            filepath, attr, future = pending.popleft()
+            if future.result() is not None:
+                yield BadFile(filepath, future.result(), attr=attr)
+
+
+def release_digest(dist_dir):
+    """ Digest over all the Release files of a dist """
+    m = hashlib.sha256()
+    for release in sorted(Path(dist_dir).rglob('Release')):
+        m.update(release.as_posix().encode())
+        with open(release.as_posix(), "rb") as f:
+            m.update(f.read())
+    return m.hexdigest()
+
+
+def is_dist_unchanged(dist_dir, metadata, options):
+    """ True if the Release files and all present metadata files are as in the last clean run """
+    cache = options.cache
+    if cache.snapshot(dist_dir) != release_digest(dist_dir):
+        return False
+    for path, attr in metadata.items():
+        try:
+            s = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if not cache.is_verified(path, s, checksum_key(attr, select_digests(attr, options.digest))):
+            return False
+    return True
+
+
+def timed_walk(dirpath, stats):
+    """ os.walk, counting the time spent listing directories as discovery """
+    walker = os.walk(dirpath)
+    while True:
+        with stats.timed("discovery"):
+            item = next(walker, None)
+        if item is None:
+            return
+        yield item
+
+
+def bad_files_in_dir(dirpath, attrs, options=None, report_missing=False):
+    """ Checks the files under dirpath which are in attrs
+
+    With report_missing, files of attrs which the walk did not come across are
+    yielded as MISSING at the end, found by set difference without extra syscalls.
+    """
+    if options is None:
+        options = CheckOptions()
+    seen = set()
+
+    def candidates():
+        for root, _, files in timed_walk(dirpath, options.stats):
+            for filename in files:
+                if filename == "Release":
+                   continue
+                filepath = os.path.join(root, filename)
+                if filepath in attrs:
+                    if report_missing:
+                        seen.add(filepath)
+                    yield filepath, attrs[filepath]
+
+    yield from bad_files(candidates(), options)
+
+    if report_missing:
+        missing = sorted(filepath for filepath in attrs if filepath not in seen)
+        options.stats.add("files_missing", len(missing))
+        for filepath in missing:
+            attr = attrs[filepath]
+            options.report(filepath, MISSING, check="walk", expected_size=attr.size)
+            yield BadFile(filepath, MISSING, attr=attr)
+
+
+def bad_files_in_index(attrs, options=None):
+    """ Checks the files an index refers to without listing any directory
+
+    Paths are visited in directory order, so the files of a directory are stat'ed
+    together, and files which do not exist are reported as MISSING. attrs is a
+    PoolIndex, which builds the absolute paths one directory at a time.
+    """
+    yield from bad_files(attrs.sorted_items(), options)
 
 
 def compare_in_release(release_path):
@@ -178,7 +1275,6 @@ def compare_in_release(release_path):
         if line.strip() == "-----BEGIN PGP SIGNATURE-----":
             stop_idx = i
     if release_lines != inrelease_lines[start_idx:stop_idx]:
-        print(inrelease_path, "differs from the Release file")
         yield inrelease_path
 
 
@@ -195,6 +1291,8 @@ def trim_path(path, trim):
 
 
 def get_new_downloaded_pkg(base_dir):
+    """ Paths of the files the last apt-mirror run downloaded, including those that are not on disk
+    (e.g. a 404), which are reported as MISSING when an index refers to them """
     try:
         with open(os.path.join(base_dir, "var/NEW"), "r") as f:
             for line in f:
@@ -202,14 +1300,90 @@ def get_new_downloaded_pkg(base_dir):
                     url = urlparse(line)
                     filepath = os.path.join(base_dir, "mirror", url.hostname, url.path.lstrip('/'))
                     #print(filepath)
-                    if os.path.isfile(filepath):
-                        yield filepath
+                    yield filepath
 
     except FileNotFoundError:
         return
 
 
-def bad_files_in_mirror(base_dir, mirror_dir, is_flat_repo, all_package_check=False):
+def refetch_urls(base_dir, paths, scheme="http"):
+    """ The upstream URL of each path under base_path/mirror, as a list of (path, url)
+
+    apt-mirror stores http://host/path as mirror/host/path, dropping the scheme and the
+    port, so the URLs are looked up in the lists apt-mirror keeps in var/ and only built
+    from the path, with the given scheme, for files these do not list.
+    """
+    sites_dir = os.path.join(base_dir, "mirror")
+    urls = dict.fromkeys(paths)
+    for url_list in URL_LISTS:
+        try:
+            with open(os.path.join(base_dir, url_list)) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    url = urlparse(line)
+                    filepath = os.path.join(sites_dir, url.hostname, url.path.lstrip('/'))
+                    if filepath in urls and urls[filepath] is None:
+                        urls[filepath] = line
+        except FileNotFoundError:
+            pass
+    for filepath, url in urls.items():
+        if url is None:
+            urls[filepath] = "%s://%s" % (scheme, os.path.relpath(filepath, sites_dir).replace(os.sep, "/"))
+    return list(urls.items())
+
+
+def write_refetch_list(f, refetch, format="wget"):
+    """ Writes (path, url) pairs as a wget -i or an aria2c -i input file """
+    for filepath, url in refetch:
+        f.write(url + "\n")
+        if format == "aria2c":
+            # aria2c saves each file straight to its place in the mirror
+            f.write("  dir=%s\n  out=%s\n" % os.path.split(filepath))
+
+
+def fetch_files(refetch, jobs=4, base_url=None, timeout=60):
+    """ Downloads (path, url, attr) triples in parallel, yielding (path, url, error) as they finish
+
+    Each file is written next to its path, checked against attr (unless it is None)
+    and only renamed over the path if it matches. With base_url, files are fetched
+    from base_url/host/path, e.g. another node's mirror directory served over HTTP,
+    instead of upstream.
+    """
+    # the mismatch details are not printed, the error returned says it all
+    check_options = CheckOptions(reporter=lambda record: None)
+
+    def fetch(filepath, url, attr):
+        if base_url is not None:
+            parsed = urlparse(url)
+            url = "%s/%s%s" % (base_url.rstrip("/"), parsed.hostname, parsed.path)
+        tmp_path = filepath + ".part"
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with urllib.request.urlopen(url, timeout=timeout) as response, open(tmp_path, "wb") as f:
+                shutil.copyfileobj(response, f, HASH_CHUNK_SIZE)
+            if attr is not None and not is_checksum_correct(tmp_path, attr, check_options):
+                os.unlink(tmp_path)
+                return filepath, url, "the download does not match the index either"
+            os.replace(tmp_path, filepath)
+        except OSError as e:  # URLError and HTTPError included
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            return filepath, url, e
+        return filepath, url, None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch, filepath, url, attr) for filepath, url, attr in refetch]
+        for future in futures:
+            yield future.result()
+
+
+def bad_files_in_mirror(base_dir, mirror_dir, is_flat_repo, all_package_check=False, options=None, new_pkgs=None):
+    if options is None:
+        options = CheckOptions()
+    cache, stats = options.cache, options.stats
+
     if is_flat_repo:
         pool_dir = os.path.normpath(mirror_dir)
         dist_dirs = [ pool_dir ]
@@ -221,22 +1395,225 @@ def bad_files_in_mirror(base_dir, mirror_dir, is_flat_repo, all_package_check=Fa
         dist_dirs = [os.path.join(dist_root, subdir) for subdir in subdirs]
         pool_dir = trim_path(mirror_dir, "dists")
 
-    for dist_dir in dist_dirs:
-        release_path = next(glob.iglob(dist_dir+'/**/Release', recursive=True))
-        click.echo("checking %s ..." % dist_dir)
-        # check if InRelease and Release file differs
-        yield from compare_in_release(release_path)
-        # check size and hashes of metadata files
-        yield from bad_files_in_dir(dist_dir, dist_attrs(dist_dir))
-        # check size and hashes of .deb package files
+    # in incremental mode, digests of the Release files and indices to remember if the mirror is clean
+    snapshots = []
+    # only the --all-package-check walk skips what did not change, a check of var/NEW needs every index
+    incremental = options.incremental and all_package_check
+    unchanged_dists, unchanged_indices = [], set()
+
+    def check():
+        # suites usually share one pool, so merge their indices and check each pool file once
+        attrs = PoolIndex(pool_dir, None if options.shard is None else options.in_shard)
+        for dist_dir in dist_dirs:
+            stats.begin(mirror_dir, "metadata" if is_flat_repo else os.path.relpath(dist_dir, mirror_dir))
+            with stats.timed("discovery"):
+                release_path = next(glob.iglob(dist_dir+'/**/Release', recursive=True))
+            with stats.timed("release"):
+                metadata = dist_attrs(dist_dir)
+            all_metadata = metadata
+            if options.shard is not None:
+                metadata = {path: attr for path, attr in metadata.items() if options.in_shard(path)}
+            index_filter = None
+            if incremental:
+                if is_dist_unchanged(dist_dir, metadata, options):
+                    options.echo("skipping unchanged %s" % dist_dir)
+                    unchanged_dists.append(dist_dir)
+                    continue
+                snapshots.append((dist_dir, release_digest(dist_dir)))
+
+                def index_filter(index_path, metadata=all_metadata):
+                    # only entries of indices which changed since the last clean run need checking
+                    attr = metadata.get(index_path)
+                    if attr is None:
+                        return True
+                    checksum = checksum_key(attr)
+                    snapshots.append((index_path, checksum))
+                    if cache.snapshot(index_path) != checksum:
+                        return True
+                    unchanged_indices.add(index_path)
+                    return False
+
+            options.echo("checking %s ..." % dist_dir)
+            # check if InRelease and Release file differs
+            with stats.timed("release"):
+                differs = list(compare_in_release(release_path))
+            for inrelease_path in differs:
+                if options.in_shard(inrelease_path):
+                    options.report(inrelease_path, CORRUPTED, "differs from the Release file", check="release")
+                    yield BadFile(inrelease_path, CORRUPTED)
+            # check size and hashes of metadata files
+            yield from bad_files_in_dir(dist_dir, metadata, options)
+            with stats.timed("packages"):
+                pool_attrs(dist_dir, pool_dir, attrs, index_filter)
+
+        # check size and hashes of the package and source files
+        stats.begin(mirror_dir, "pool")
+        options.echo("checking %s ..." % pool_dir)
         if all_package_check:
-            yield from bad_files_in_dir(pool_dir, pool_attrs(dist_dir, pool_dir))
+            if options.index_driven:
+                yield from bad_files_in_index(attrs, options)
+            elif attrs:
+                # Release also lists index variants apt-mirror does not fetch, so only
+                # the pool is checked for missing files
+                yield from bad_files_in_dir(pool_dir, attrs, options, report_missing=True)
+            if unchanged_dists or unchanged_indices:
+                yield from bad_files(unchanged_suspects(attrs), options)
         else:
-            attrs = pool_attrs(dist_dir, pool_dir)
-            for package_path in get_new_downloaded_pkg(base_dir):
-                if package_path.startswith(mirror_dir) and package_path in attrs:
-                    if not is_checksum_correct(package_path, attrs[package_path]):
-                        yield package_path
+            pkgs = new_pkgs if new_pkgs is not None else set(get_new_downloaded_pkg(base_dir))
+            yield from bad_files(((package_path, attrs[package_path])
+                                  for package_path in sorted(pkgs)
+                                  if package_path.startswith(mirror_dir) and package_path in attrs), options)
+        stats.end()
+
+    def unchanged_suspects(attrs):
+        """ Entries of skipped indices which still need checking: the files apt-mirror just
+        downloaded and those whose stat changed since they were verified, which takes a stat
+        of every cached pool file """
+        with stats.timed("discovery"):
+            suspects = {path for path in (new_pkgs if new_pkgs is not None else get_new_downloaded_pkg(base_dir))
+                        if path.startswith(mirror_dir)}
+            suspects.update(cache.changed_paths(os.path.join(pool_dir, "")))
+        suspects = {path for path in suspects if path not in attrs and options.in_shard(path)}
+        if not suspects:
+            return
+        recheck = PoolIndex(pool_dir, suspects.__contains__)
+        with stats.timed("packages"):
+            for dist_dir in dist_dirs:
+                if dist_dir in unchanged_dists:
+                    pool_attrs(dist_dir, pool_dir, recheck)
+                elif unchanged_indices:
+                    pool_attrs(dist_dir, pool_dir, recheck, unchanged_indices.__contains__)
+        yield from recheck.sorted_items()
+
+    has_bad = False
+    for bad_file in check():
+        has_bad = True
+        yield bad_file
+    # a --quick run proves nothing about the content, so later runs must not skip what it saw
+    if incremental and not options.quick and not has_bad:
+        cache.store_snapshots(snapshots)
+
+    if options.orphans:
+        # indices skipped by --incremental still reference files, so they are all read again here
+        options.echo("looking for orphans in %s ..." % pool_dir)
+        scan_dir = os.path.join(pool_dir, "pool")
+        if is_flat_repo or not os.path.isdir(scan_dir):
+            scan_dir = pool_dir
+        for orphan in orphan_files(pool_dir, scan_dir, referenced_paths(pool_dir, dist_dirs)):
+            if options.in_shard(orphan.path):
+                options.report(orphan.path, ORPHAN, check="orphan", actual_size=orphan.size)
+                yield orphan
+
+
+def move_file(source, target):
+    """ Renames source to target, copying when they are on different file systems
+
+    A copy is written next to target and renamed into place once synced, and the
+    source is only removed after that, so target never appears half written.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:  # e.g. var/ and a symlinked mirror volume
+            raise
+        tmp_path = target + ".part"
+        shutil.copy2(source, tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target)
+        os.unlink(source)
+
+
+def fsync_dirs(dirs):
+    """ Makes the renames in dirs durable """
+    for dirpath in dirs:
+        fd = os.open(dirpath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def new_quarantine_run(quarantine_dir):
+    """ Creates and returns the directory of a new quarantine run under quarantine_dir
+
+    Runs are named by their start time, which keeps them sorted by name, then the
+    host and pid; the directory is created exclusively, so two runs started in the
+    same second (even from hosts sharing the mirror) never share a manifest.
+    """
+    os.makedirs(quarantine_dir, exist_ok=True)
+    name = "%s-%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.uname().nodename, os.getpid())
+    run_dir, n = os.path.join(quarantine_dir, name), 1
+    while True:
+        try:
+            os.mkdir(run_dir)
+            return run_dir
+        except FileExistsError:
+            n += 1
+            run_dir = os.path.join(quarantine_dir, "%s.%d" % (name, n))
+
+
+def quarantine_files(run_dir, sites_dir, paths, batch_size=QUARANTINE_BATCH):
+    """ Moves files from sites_dir to the same relative path under run_dir, yielding each moved path
+
+    The manifest lines of a batch reach the disk before its files are moved, and the
+    directories it touched are synced after, so restore_quarantine finds every moved
+    file even after a crash in the middle.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, QUARANTINE_MANIFEST), "a") as manifest:
+        for i in range(0, len(paths), batch_size):
+            batch = []
+            for path in paths[i:i + batch_size]:
+                s = os.stat(path)
+                batch.append((path, os.path.relpath(path, sites_dir)))
+                manifest.write(json.dumps({"path": batch[-1][1], "size": s.st_size, "mtime_ns": s.st_mtime_ns,
+                                           "quarantined_at": time.time()}) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+            moved, dirs = [], set()
+            for path, relpath in batch:
+                target = os.path.join(run_dir, relpath)
+                move_file(path, target)
+                moved.append(path)
+                dirs.update((os.path.dirname(path), os.path.dirname(target)))
+            fsync_dirs(dirs)
+            yield from moved
+
+
+def restore_quarantine(run_dir, sites_dir, dry_run=False):
+    """ Moves the files of a quarantine run back, yielding (path, restored)
+
+    A file is not restored over one apt-mirror has downloaded again since; it stays in
+    run_dir, which is removed once it is empty.
+    """
+    manifest_path = os.path.join(run_dir, QUARANTINE_MANIFEST)
+    with open(manifest_path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    dirs = set()
+    for entry in entries:
+        source = os.path.join(run_dir, entry["path"])
+        path = os.path.join(sites_dir, entry["path"])
+        if not os.path.exists(source):
+            continue  # the batch was interrupted before this file was moved
+        if os.path.exists(path):
+            yield path, False
+            continue
+        if not dry_run:
+            move_file(source, path)
+            dirs.update((os.path.dirname(source), os.path.dirname(path)))
+        yield path, True
+    if dry_run:
+        return
+    fsync_dirs(dirs)
+
+    for root, _, _ in os.walk(run_dir, topdown=False):
+        if root != run_dir and not os.listdir(root):
+            os.rmdir(root)
+    if os.listdir(run_dir) == [QUARANTINE_MANIFEST]:
+        os.unlink(manifest_path)
+        os.rmdir(run_dir)
 
 
 def all_mirrors(sites_dir):
@@ -280,26 +1657,299 @@ def get_sites_dir(base_dir):
     return sites_dir
 
 
+def parse_max_delete(ctx, param, value):
+    """ N or N% of the files checked, as (number, is_percent) """
+    if value is None:
+        return None
+    m = re.match(r"^(\d+(?:\.\d+)?)(%?)$", value)
+    if m is None or (not m.group(2) and "." in m.group(1)):
+        raise click.BadParameter("expected a number of files or a percentage, e.g. 100 or 0.5%")
+    return float(m.group(1)) if m.group(2) else int(m.group(1)), bool(m.group(2))
+
+
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    m = re.match(r"^(\d+)/(\d+)$", value)
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise click.BadParameter("expected K/N with 1 <= K <= N, e.g. 2/4")
+    return int(m.group(1)), int(m.group(2))
+
+
 @click.command("Checking for corrupted files in apt-mirror files")
 @click.option("-b", "--base-dir", type=click.Path(exists=True, file_okay=False, readable=True, resolve_path=True),
               help="apt-mirror base_path")
 @click.option("--delete/--no-delete", is_flag=True, default=False, help="delete corrupted files")
-@click.option("--all-package-check", is_flag=True, default=False, help="check all the .deb packages (not just newely synced)")
-def cli(base_dir, delete, all_package_check):
+@click.option("--quarantine", is_flag=True, default=False,
+              help="move corrupted files to base_path/var/quarantine/ instead, apt-mirror-check-restore undoes it")
+@click.option("--max-delete", callback=parse_max_delete, default=None, metavar="N|N%",
+              help="with --delete or --quarantine, touch nothing if more files than this (or this share of the "
+                   "files checked) are corrupted")
+@click.option("--refetch-list", type=click.File("w"), default=None,
+              help="write the upstream URLs of the corrupted and missing files to this file")
+@click.option("--refetch-format", type=click.Choice(REFETCH_FORMATS), default="wget", show_default=True,
+              help="--refetch-list for wget -x -i (run in base_path/mirror) or for aria2c -i")
+@click.option("--refetch-scheme", type=click.Choice(("http", "https")), default="http", show_default=True,
+              help="scheme of the URLs var/ALL and var/NEW do not list")
+@click.option("--fetch", is_flag=True, default=False,
+              help="download the corrupted and missing files again once the check (and --delete) is done")
+@click.option("--fetch-from", metavar="URL", default=None,
+              help="with --fetch, download from URL/<host>/<path> instead of upstream, e.g. a peer's mirror dir")
+@click.option("--fetch-jobs", type=click.IntRange(min=1), default=4, show_default=True,
+              help="downloads in parallel with --fetch")
+@click.option("--all-package-check", is_flag=True, default=False, help="check all the package and source files (not just newely synced)")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1, show_default=True,
+              help="number of files verified in parallel")
+@click.option("--async-io", "aio", is_flag=True, default=False,
+              help="check files with an asyncio pipeline bounded by --max-stat and --max-read instead of --jobs")
+@click.option("--max-stat", type=click.IntRange(min=1), default=64, show_default=True,
+              help="stat calls in flight with --async-io")
+@click.option("--max-read", type=click.IntRange(min=1), default=8, show_default=True,
+              help="files read and hashed at the same time with --async-io")
+@click.option("--mmap-threshold", type=click.IntRange(min=0), default=0, show_default=True,
+              help="hash files of at least this many bytes through mmap instead of read(), 0 never does; "
+                   "only for local disks, a file truncated while mapped kills the process")
+@click.option("--io-hints/--no-io-hints", default=True, show_default=True,
+              help="advise the kernel of sequential reads and drop hashed files from the page cache")
+@click.option("--direct-io", is_flag=True, default=False,
+              help="read files with O_DIRECT, bypassing the page cache, where the file system allows it")
+@click.option("--max-read-rate", type=click.FloatRange(min=0, min_open=True), default=None,
+              help="limit reading to this many MB/s in total")
+@click.option("--max-files-per-sec", type=click.FloatRange(min=0, min_open=True), default=None,
+              help="limit the number of files checked per second in total")
+@click.option("--cache/--no-cache", default=True, show_default=True,
+              help="skip hashing files unchanged since they were last verified")
+@click.option("--cache-max-age", type=click.FloatRange(min=0), default=None,
+              help="re-hash files verified more than this many days ago")
+@click.option("--incremental", is_flag=True, default=False,
+              help="skip dists and Packages indices unchanged since the last clean run")
+@click.option("--index-driven", is_flag=True, default=False,
+              help="with --all-package-check, stat the files listed in Packages instead of walking the pool, "
+                   "reporting missing ones")
+@click.option("--quick", is_flag=True, default=False,
+              help="only check that every file exists with the expected size, in the whole mirror")
+@click.option("--digest", type=click.Choice(DIGEST_POLICIES), default="strongest", show_default=True,
+              help="digests computed per file: the strongest available, the fastest SHA on this machine, or all")
+@click.option("--orphans", is_flag=True, default=False,
+              help="also list pool files no index refers to and the space they take")
+@click.option("--shard", callback=parse_shard, default=None, metavar="K/N",
+              help="only check the K-th of N disjoint slices of the mirror, e.g. 1/4 on the first of four hosts")
+@click.option("--result-json", type=click.File("w"), default=None,
+              help="write the bad files found as JSON, to combine shards with apt-mirror-check-merge")
+@click.option("--format", "report_format", type=click.Choice(REPORT_FORMATS), default="text", show_default=True,
+              help="jsonl or csv streams a record for every checked file to stdout, the rest goes to stderr")
+@click.option("--metrics-file", type=click.Path(dir_okay=False, writable=True, resolve_path=True), default=None,
+              help="keep an OpenMetrics textfile (e.g. for node_exporter's textfile collector) updated during the run")
+@click.option("--metrics-interval", type=click.FloatRange(min=1), default=60, show_default=True,
+              help="seconds between the updates of --metrics-file")
+@click.option("--stats", "show_stats", is_flag=True, default=False,
+              help="print time and throughput per mirror and dist at the end")
+@click.option("--stats-json", type=click.File("w"), default=None,
+              help="write the --stats figures as JSON to this file ('-' for stdout)")
+def cli(base_dir, delete, quarantine, max_delete, refetch_list, refetch_format, refetch_scheme, fetch, fetch_from,
+        fetch_jobs, all_package_check, jobs, aio, max_stat, max_read, mmap_threshold, io_hints, direct_io,
+        max_read_rate, max_files_per_sec, cache, cache_max_age, incremental, index_driven, quick, digest, orphans,
+        shard, result_json, report_format, metrics_file, metrics_interval, show_stats, stats_json):
     sites_dir = get_sites_dir(base_dir)
+    base_dir = os.path.dirname(sites_dir)
+    if incremental and not cache:
+        raise click.BadOptionUsage("--incremental", "--incremental needs the cache, do not combine it with --no-cache")
+    if delete and quarantine:
+        raise click.BadOptionUsage("--quarantine", "--quarantine moves the files --delete would remove, use one of them")
+
+    verify_cache = None
+    if cache:
+        cache_path = os.path.join(base_dir, CACHE_FILE if shard is None else SHARD_CACHE_FILE.format(*shard))
+        max_age = None if cache_max_age is None else cache_max_age * 24 * 3600
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            verify_cache = VerifyCache(cache_path, max_age)
+        except (OSError, sqlite3.Error) as e:
+            # e.g. a read-only export of the mirror, checking still works without the cache
+            click.secho("warning: cannot use the cache %s (%s), checking without it" % (cache_path, e),
+                        color="yellow", err=True)
+            if incremental:
+                click.secho("warning: --incremental is ignored without the cache", color="yellow", err=True)
+                incremental = False
+
+    if quick:
+        all_package_check = True
+    options = CheckOptions(jobs, verify_cache, incremental, index_driven, orphans, quick, digest, aio, max_stat,
+                           max_read, mmap_threshold, io_hints, direct_io,
+                           None if max_read_rate is None else TokenBucket(max_read_rate * 1024 * 1024),
+                           None if max_files_per_sec is None else TokenBucket(max_files_per_sec),
+                           shard, sites_dir,
+                           None if report_format == "text" else Reporter(report_format, sys.stdout))
+    stats = options.stats
+    echo = options.echo
+    metrics = None
+    if metrics_file is not None:
+        metrics = MetricsFile(metrics_file, stats, metrics_interval)
+        metrics.start()
+    results = []  # for --result-json, paths relative to sites_dir
+    # corrupted files to delete or quarantine, only acted on once the whole mirror is checked
+    removals = collections.OrderedDict()  # path -> mirror
+    refetch_paths = collections.OrderedDict()  # corrupted and missing files to their attr, for --refetch-list and --fetch
+
+    # var/NEW lists the files synced by the last apt-mirror run, shared by all mirrors
+    new_pkgs = None if all_package_check else set(get_new_downloaded_pkg(base_dir))
 
     has_bad = False
-    for mirror, is_flat_repo in all_mirrors(sites_dir):
-        for bad_file in bad_files_in_mirror(base_dir, mirror, is_flat_repo, all_package_check):
-            has_bad = True
+    orphan_count, orphan_bytes = 0, 0
+    try:
+        start = time.perf_counter()
+        mirrors = list(all_mirrors(sites_dir))
+        stats.discovery += time.perf_counter() - start
+
+        for mirror, is_flat_repo in mirrors:
+            for bad_file in bad_files_in_mirror(base_dir, mirror, is_flat_repo, all_package_check, options,
+                                                new_pkgs):
+                if metrics is not None:
+                    metrics.count(mirror, bad_file.category)
+                if result_json is not None:
+                    results.append({"path": os.path.relpath(bad_file.path, sites_dir),
+                                    "category": bad_file.category, "size": bad_file.size,
+                                    "deleted": False, "quarantined": False})
+                if bad_file.category == ORPHAN:
+                    orphan_count += 1
+                    orphan_bytes += bad_file.size
+                    echo("[ORPHAN] %s (%d bytes)" % (bad_file.path, bad_file.size))
+                    continue
+                has_bad = True
+                if refetch_list is not None or fetch:
+                    refetch_paths[bad_file.path] = bad_file.attr
 
-            if delete:
-                os.unlink(bad_file)
-                prefix = "[DELETED] "
+                if bad_file.category == MISSING:
+                    prefix = "[MISSING] "
+                else:
+                    if delete or quarantine:
+                        removals[bad_file.path] = mirror
+                    prefix = "[ERROR] "
+                click.secho(prefix + bad_file.path, color="red", err=options.reporter is not None)
+
+        if removals:
+            limit = None
+            if max_delete is not None:
+                limit, is_percent = max_delete
+                if is_percent:
+                    limit = stats.as_dict()["total"]["files_checked"] * limit / 100
+            if limit is not None and len(removals) > limit:
+                fetch = False  # the index is as suspect as the files
+                click.secho("%d corrupted files is more than --max-delete allows, nothing was %s" % (
+                    len(removals), "quarantined" if quarantine else "deleted"), color="red", err=True)
             else:
-                prefix = "[ERROR] "
-            click.secho(prefix + bad_file, color="red")
+                if quarantine:
+                    action = "quarantined"
+                    run_dir = new_quarantine_run(os.path.join(base_dir, QUARANTINE_DIR))
+                    removed = quarantine_files(run_dir, sites_dir, list(removals))
+                else:
+                    action = "deleted"
+
+                    def unlink_files(paths):
+                        for path in paths:
+                            os.unlink(path)
+                            yield path
+                    removed = unlink_files(removals)
+                removed_paths = set()
+                for path in removed:
+                    removed_paths.add(path)
+                    if metrics is not None:
+                        metrics.count(removals[path], action)
+                    click.secho("[%s] %s" % (action.upper(), path), color="red", err=options.reporter is not None)
+                for result in results:
+                    if os.path.join(sites_dir, result["path"]) in removed_paths:
+                        result[action] = True
+                if quarantine:
+                    echo("%d files quarantined in %s" % (len(removed_paths), run_dir))
+
+        if refetch_paths:
+            refetch = refetch_urls(base_dir, refetch_paths, refetch_scheme)
+            if refetch_list is not None:
+                write_refetch_list(refetch_list, refetch, refetch_format)
+            if fetch:
+                fetched = 0
+                for path, url, error in fetch_files([(path, url, refetch_paths[path]) for path, url in refetch],
+                                                    fetch_jobs, fetch_from):
+                    if error is None:
+                        fetched += 1
+                        echo("[FETCHED] %s" % path)
+                    else:
+                        click.secho("[FETCH FAILED] %s: %s %s" % (path, url, error), color="red", err=True)
+                echo("%d of %d files downloaded again" % (fetched, len(refetch)))
+    except BaseException:
+        if metrics is not None:
+            metrics.finish(2)
+        raise
+    finally:
+        if verify_cache is not None:
+            verify_cache.close()
+    if metrics is not None:
+        metrics.finish(1 if has_bad else 0)
+
+    if orphans:
+        echo("%d orphan files, %.1f MB reclaimable" % (orphan_count, orphan_bytes / 1024 / 1024))
+    if show_stats:
+        echo(stats.format())
+    if stats_json is not None:
+        json.dump(stats.as_dict(), stats_json, indent=2)
+        stats_json.write("\n")
+    if result_json is not None:
+        json.dump({"shard": None if shard is None else "%d/%d" % shard, "sites_dir": sites_dir,
+                   "bad_files": results, "exit_code": 1 if has_bad else 0,
+                   "stats": stats.as_dict()["total"]}, result_json, indent=2)
+        result_json.write("\n")
+
+    if not has_bad:
+        echo("No error found!")
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@click.command("Combine the --result-json reports of sharded apt-mirror-check runs")
+@click.argument("reports", nargs=-1, required=True, type=click.File("r"))
+@click.option("--allow-partial", is_flag=True, default=False, help="do not fail when shards are missing")
+def merge_cli(reports, allow_partial):
+    shards = {}
+    for report in reports:
+        result = json.load(report)
+        shard = result.get("shard") or "1/1"
+        if shard in shards:
+            raise click.UsageError("shard %s is given twice (%s)" % (shard, report.name))
+        shards[shard] = result
+
+    counts = {int(shard.split("/")[1]) for shard in shards}
+    if len(counts) != 1:
+        raise click.UsageError("reports are from different shard counts: %s" % ", ".join(sorted(shards)))
+    count = counts.pop()
+    absent = [str(k) for k in range(1, count + 1) if "%d/%d" % (k, count) not in shards]
+    if absent and not allow_partial:
+        raise click.UsageError("no report for shard(s) %s of %d" % (", ".join(absent), count))
+
+    has_bad = False
+    totals = collections.Counter()
+    bad_files = sorted((bad_file for result in shards.values() for bad_file in result["bad_files"]),
+                       key=lambda bad_file: (bad_file["category"], bad_file["path"]))
+    for bad_file in bad_files:
+        if bad_file["category"] == ORPHAN:
+            click.echo("[ORPHAN] %s (%d bytes)" % (bad_file["path"], bad_file["size"]))
+            continue
+        has_bad = True
+        if bad_file["category"] == MISSING:
+            prefix = "[MISSING] "
+        elif bad_file["deleted"]:
+            prefix = "[DELETED] "
+        elif bad_file.get("quarantined"):
+            prefix = "[QUARANTINED] "
+        else:
+            prefix = "[ERROR] "
+        click.secho(prefix + bad_file["path"], color="red")
+    for result in shards.values():
+        totals.update({k: v for k, v in result["stats"].items() if k in Stats.COUNTERS})
+    click.echo("%d of %d shards, %d files checked, %d skipped, %.1f MB hashed" % (
+        len(shards), count, totals["files_checked"], totals["files_skipped"], totals["bytes_hashed"] / 1024 / 1024))
 
+    has_bad = has_bad or any(result["exit_code"] for result in shards.values())
     if not has_bad:
         click.echo("No error found!")
         sys.exit(0)
@@ -307,5 +1957,40 @@ def cli(base_dir, delete, all_package_check):
         sys.exit(1)
 
 
+@click.command("Move files quarantined by apt-mirror-check --quarantine back into the mirror")
+@click.option("-b", "--base-dir", type=click.Path(exists=True, file_okay=False, readable=True, resolve_path=True),
+              help="apt-mirror base_path")
+@click.option("--list", "list_runs", is_flag=True, default=False, help="list the quarantine runs and exit")
+@click.option("--dry-run", is_flag=True, default=False, help="only print what would be restored")
+@click.argument("run", required=False)
+def restore_cli(base_dir, list_runs, dry_run, run):
+    """ Restores the quarantine RUN (a directory name under var/quarantine/), the latest one by default """
+    sites_dir = get_sites_dir(base_dir)
+    quarantine_dir = os.path.join(os.path.dirname(sites_dir), QUARANTINE_DIR)
+    runs = sorted(name for name in (os.listdir(quarantine_dir) if os.path.isdir(quarantine_dir) else [])
+                  if os.path.isfile(os.path.join(quarantine_dir, name, QUARANTINE_MANIFEST)))
+
+    if list_runs:
+        for name in runs:
+            with open(os.path.join(quarantine_dir, name, QUARANTINE_MANIFEST)) as f:
+                click.echo("%s  %d files" % (name, sum(1 for line in f if line.strip())))
+        sys.exit(0)
+    if run is None:
+        if not runs:
+            raise click.UsageError("nothing is quarantined in %s" % quarantine_dir)
+        run = runs[-1]
+    elif run not in runs:
+        raise click.BadParameter("no quarantine run %s in %s" % (run, quarantine_dir), param_hint="RUN")
+
+    kept = 0
+    for path, restored in restore_quarantine(os.path.join(quarantine_dir, run), sites_dir, dry_run):
+        if restored:
+            click.echo("[RESTORED] %s" % path)
+        else:
+            kept += 1
+            click.echo("[KEPT] %s (downloaded again, the quarantined copy stays in %s)" % (path, run))
+    sys.exit(1 if kept else 0)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+Compares the read() and the mmap hashing paths of apt_mirror_check on one large file.
+
+Usage: python benchmarks/bench_hashing.py [FILE] [--size MB] [--repeat N] [--digest POLICY]
+
+Without FILE a temporary file of --size MB (default 48, about a Contents-amd64.gz) is created.
+The file is read once beforehand, so both paths are timed with a warm page cache.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+def expected_attr(path):
+    attr = apt_mirror_check.FileAttr(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    attr.size = len(data)
+    for _, name, constructor in apt_mirror_check.DIGESTS:
+        setattr(attr, name, constructor(data).hexdigest())
+    return attr
+
+
+def run(name, path, attr, options, repeat):
+    s = os.stat(path)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert apt_mirror_check.hash_file(path, attr, s, options)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<8} {:>8.3f} s {:>8.1f} MB/s".format(name, best, s.st_size / 1024 / 1024 / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare read() and mmap hashing")
+    parser.add_argument("file", nargs="?")
+    parser.add_argument("--size", type=int, default=48, help="size in MB of the generated file")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--digest", choices=apt_mirror_check.DIGEST_POLICIES, default="strongest")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        path = args.file
+        if path is None:
+            tmp.write(os.urandom(args.size * 1024 * 1024))
+            tmp.flush()
+            path = tmp.name
+        attr = expected_attr(path)
+
+        run("read", path, attr, apt_mirror_check.CheckOptions(digest=args.digest), args.repeat)
+        run("mmap", path, attr, apt_mirror_check.CheckOptions(digest=args.digest, mmap_threshold=1), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# coding: utf-8
+"""
+Compares the line based pkg_attrs parser with the block based pkg_records parser.
+
+Usage: python benchmarks/bench_packages_parser.py /path/to/main/binary-amd64/Packages [repeat]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+def run(name, parse, path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in parse(path))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    for _ in parse(path):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    print("{:<12} {:>8} stanzas {:>8.3f} s {:>10.0f} stanzas/s {:>8.1f} MB/s {:>8.1f} MB peak".format(
+        name, count, best, count / best, size_mb / best, peak / 1024 / 1024))
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__.strip())
+    path = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    run("pkg_attrs", apt_mirror_check.pkg_attrs, path, repeat)
+    run("pkg_records", apt_mirror_check.pkg_records, path, repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# coding: utf-8
+"""
+Times the phases of apt_mirror_check on a synthetic mirror.
+
+Usage: python benchmarks/run_benchmarks.py [--base-dir DIR] [--packages N] [--size BYTES] [--json FILE] ...
+
+Without --base-dir a temporary mirror is generated (see synthetic_mirror.py) and removed afterwards.
+Peak RSS is read from VmHWM in /proc, it is reset before each phase where the kernel allows it,
+the full cli run is measured in a child process which reports its own peak.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+
+import apt_mirror_check  # noqa: E402
+import synthetic_mirror  # noqa: E402
+
+
+# ru_maxrss survives fork and exec, VmHWM of the new address space does not
+CLI_WRAPPER = """
+import re, runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    with open("/proc/self/status") as f:
+        print(int(re.search(r"VmHWM:\\s+(\\d+)", f.read()).group(1)) / 1024, file=sys.stderr)
+"""
+
+
+def peak_rss_mb():
+    with open("/proc/self/status") as f:
+        return int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1)) / 1024
+
+
+def reset_peak_rss():
+    """ Starts a new peak RSS measurement, needs Linux >= 4.0 """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def report(results, name, elapsed, files=None, nbytes=None, peak_mb=None):
+    result = {"name": name, "seconds": round(elapsed, 4), "peak_rss_mb": round(peak_mb or peak_rss_mb(), 1)}
+    line = "{:<22} {:>9.3f} s".format(name, elapsed)
+    if files is not None:
+        result["files"] = files
+        result["files_per_sec"] = round(files / elapsed, 1) if elapsed else None
+        line += " {:>8} files {:>10.0f} files/s".format(files, files / elapsed if elapsed else 0)
+    if nbytes is not None:
+        result["mb_per_sec"] = round(nbytes / 1024 / 1024 / elapsed, 1) if elapsed else None
+        line += " {:>8.1f} MB/s".format(nbytes / 1024 / 1024 / elapsed if elapsed else 0)
+    line += " {:>8.1f} MB peak RSS".format(result["peak_rss_mb"])
+    print(line)
+    results.append(result)
+
+
+def run(base_dir, jobs):
+    results = []
+    sites_dir = os.path.join(base_dir, "mirror")
+    mirrors = list(apt_mirror_check.all_mirrors(sites_dir))
+
+    dist_dirs = []
+    for mirror_dir, is_flat_repo in mirrors:
+        dists_root = os.path.join(mirror_dir, "dists")
+        dist_dirs += [os.path.join(dists_root, d) for d in sorted(os.listdir(dists_root))] \
+            if not is_flat_repo else [mirror_dir]
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    metadata = sum(len(apt_mirror_check.dist_attrs(dist_dir)) for dist_dir in dist_dirs)
+    report(results, "dist_attrs", time.perf_counter() - start, metadata)
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    indices = []
+    for mirror_dir, is_flat_repo in mirrors:
+        pool_dir = mirror_dir if is_flat_repo else apt_mirror_check.trim_path(mirror_dir, "dists")
+        attrs = apt_mirror_check.PoolIndex(pool_dir)
+        for dist_dir in dist_dirs:
+            if dist_dir.startswith(mirror_dir):
+                apt_mirror_check.pool_attrs(dist_dir, pool_dir, attrs)
+        indices.append(attrs)
+    report(results, "pool_attrs", time.perf_counter() - start, sum(len(attrs) for attrs in indices))
+
+    files = nbytes = 0
+    reset_peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # mismatches are printed
+        for attrs in indices:
+            for path, attr in attrs.items():
+                if os.path.exists(path):
+                    nbytes += os.path.getsize(path)
+                    files += 1
+                    apt_mirror_check.is_checksum_correct(path, attr)
+    report(results, "is_checksum_correct", time.perf_counter() - start, files, nbytes)
+
+    cmd = [sys.executable, "-c", CLI_WRAPPER, os.path.join(BENCH_DIR, os.pardir, "apt_mirror_check.py"),
+           "--base-dir", base_dir, "--all-package-check", "--no-cache", "--jobs", str(jobs)]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    report(results, "cli (jobs=%d)" % jobs, elapsed, files, nbytes, float(proc.stderr.split()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark apt_mirror_check on a synthetic mirror")
+    parser.add_argument("--base-dir", help="existing apt-mirror base_path to benchmark instead of a generated one")
+    parser.add_argument("--packages", type=int, default=2000, help="packages per suite of the generated mirror")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="mean package size of the generated mirror")
+    parser.add_argument("--corrupt-rate", type=float, default=0.01)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="--jobs used for the cli run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir = args.base_dir
+        if base_dir is None:
+            base_dir = os.path.join(tmp, "apt-mirror")
+            start = time.perf_counter()
+            synthetic_mirror.generate(base_dir, packages=args.packages, size=args.size,
+                                      corrupt_rate=args.corrupt_rate)
+            print("generated mirror in %.1f s" % (time.perf_counter() - start))
+        results = run(base_dir, args.jobs)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
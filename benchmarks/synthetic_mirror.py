@@ -0,0 +1,143 @@
+# coding: utf-8
+"""
+Generates a synthetic apt-mirror base_path for benchmarking apt_mirror_check.
+
+Layout: <base>/mirror/<site>/<path>/dists/<suite>/{Release,InRelease,main/binary-<arch>/Packages*},
+<base>/mirror/<site>/<path>/pool/main/... and <base>/var/NEW listing every pool file.
+
+Usage: python benchmarks/synthetic_mirror.py BASE_DIR [--packages N] [--size BYTES] ...
+"""
+
+import argparse
+import gzip
+import hashlib
+import lzma
+import os
+import random
+import shutil
+
+SITE = "archive.example.org"
+SITE_PATH = "ubuntu"
+
+
+def digests(data):
+    return hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(), hashlib.sha512(data).hexdigest()
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_release(dist_dir, suite, indices):
+    lines = ["Origin: Synthetic", "Label: Synthetic", "Suite: " + suite, "Codename: " + suite]
+    for title, idx in (("MD5Sum:", 0), ("SHA256:", 1), ("SHA512:", 2)):
+        lines.append(title)
+        for name, data in sorted(indices.items()):
+            lines.append(" %s %16d %s" % (digests(data)[idx], len(data), name))
+    release = "\n".join(lines) + "\n"
+    write_file(os.path.join(dist_dir, "Release"), release.encode())
+    inrelease = ("-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n" + release +
+                 "-----BEGIN PGP SIGNATURE-----\n\nc3ludGhldGlj\n-----END PGP SIGNATURE-----\n")
+    write_file(os.path.join(dist_dir, "InRelease"), inrelease.encode())
+
+
+def corrupt(path, rng):
+    """ Truncates, extends or flips a byte of a pool file """
+    with open(path, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        kind = rng.choice(("truncate", "extend", "flip")) if size else "extend"
+        if kind == "truncate":
+            f.truncate(rng.randrange(size))
+        elif kind == "extend":
+            f.seek(0, os.SEEK_END)
+            f.write(b"\0" * rng.randint(1, 512))
+        else:
+            offset = rng.randrange(size)
+            f.seek(offset)
+            byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([byte[0] ^ 0xff]))
+
+
+def generate(base_dir, suites=("focal", "focal-updates"), archs=("amd64",), packages=1000, shared=0.5,
+             size=64 * 1024, corrupt_rate=0.0, compress=("gz", "xz"), keep_uncompressed=True, seed=0):
+    """ Builds the mirror, returns the list of pool files which were corrupted """
+    rng = random.Random(seed)
+    shutil.rmtree(base_dir, ignore_errors=True)
+    mirror_dir = os.path.join(base_dir, "mirror", SITE, SITE_PATH)
+    new_urls = []
+    pool_files = []
+    shared_count = int(packages * shared)
+
+    for suite in suites:
+        indices = {}
+        for arch in archs:
+            stanzas = []
+            for i in range(packages):
+                name = "pkg%d" % i
+                # the first shared_count packages are identical in every suite, like a release pocket
+                version = "1.0" if i < shared_count else "1.0+%s" % suite
+                filename = "pool/main/%s/%s/%s_%s_%s.deb" % (name[0], name, name, version, arch)
+                path = os.path.join(mirror_dir, filename)
+                if not os.path.exists(path):
+                    data = rng.randbytes(max(1, int(rng.expovariate(1.0 / size))))
+                    write_file(path, data)
+                    pool_files.append(path)
+                    new_urls.append("http://%s/%s/%s" % (SITE, SITE_PATH, filename))
+                with open(path, "rb") as f:
+                    data = f.read()
+                md5sum, sha256, sha512 = digests(data)
+                stanzas.append("Package: {name}\nArchitecture: {arch}\nVersion: {version}\nPriority: optional\n"
+                               "Section: misc\nMaintainer: Nobody <nobody@example.org>\nInstalled-Size: {isize}\n"
+                               "Filename: {filename}\nSize: {size}\nMD5sum: {md5sum}\nSHA256: {sha256}\n"
+                               "SHA512: {sha512}\nDescription: synthetic package {name}\n"
+                               " Generated to benchmark apt-mirror-check.\n .\n"
+                               " Second paragraph of the long description.\n".format(
+                                   name=name, arch=arch, version=version, isize=len(data) // 1024 + 1,
+                                   filename=filename, size=len(data), md5sum=md5sum, sha256=sha256,
+                                   sha512=sha512))
+            packages_data = "\n".join(stanzas).encode() + b"\n"
+            index = "main/binary-%s/Packages" % arch
+            variants = {index: packages_data}
+            if "gz" in compress:
+                variants[index + ".gz"] = gzip.compress(packages_data)
+            if "xz" in compress:
+                variants[index + ".xz"] = lzma.compress(packages_data)
+            for name, data in variants.items():
+                if name != index or keep_uncompressed:
+                    write_file(os.path.join(mirror_dir, "dists", suite, name), data)
+            indices.update(variants)
+        write_release(os.path.join(mirror_dir, "dists", suite), suite, indices)
+
+    write_file(os.path.join(base_dir, "var", "NEW"), ("\n".join(new_urls) + "\n").encode())
+
+    corrupted = [path for path in pool_files if rng.random() < corrupt_rate]
+    for path in corrupted:
+        corrupt(path, rng)
+    return corrupted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a synthetic apt-mirror tree")
+    parser.add_argument("base_dir")
+    parser.add_argument("--suites", default="focal,focal-updates", help="comma separated suites")
+    parser.add_argument("--archs", default="amd64", help="comma separated architectures")
+    parser.add_argument("--packages", type=int, default=1000, help="packages per suite and architecture")
+    parser.add_argument("--shared", type=float, default=0.5, help="fraction of packages shared by all suites")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="mean package size in bytes")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="fraction of pool files to corrupt")
+    parser.add_argument("--compress", default="gz,xz", help="compressed index variants to write")
+    parser.add_argument("--no-uncompressed", action="store_true", help="only keep compressed Packages")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corrupted = generate(args.base_dir, args.suites.split(","), args.archs.split(","), args.packages,
+                         args.shared, args.size, args.corrupt_rate, tuple(filter(None, args.compress.split(","))),
+                         not args.no_uncompressed, args.seed)
+    print("generated %s, %d corrupted pool files" % (args.base_dir, len(corrupted)))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,9 @@ setup(
     url="https://github.com/windtail/apt_mirror_check",
     entry_points={
         "console_scripts": [
-            "apt-mirror-check = apt_mirror_check:cli"
+            "apt-mirror-check = apt_mirror_check:cli",
+            "apt-mirror-check-merge = apt_mirror_check:merge_cli",
+            "apt-mirror-check-restore = apt_mirror_check:restore_cli",
         ]
     }
 )
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import errno
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+class FileChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a_1.0_amd64.deb")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def read(self, size, **kwargs):
+        options = apt_mirror_check.CheckOptions(**kwargs)
+        return b"".join(bytes(chunk) for chunk in apt_mirror_check.file_chunks(self.path, size, options))
+
+    def test_mapped(self):
+        data = os.urandom(apt_mirror_check.HASH_CHUNK_SIZE * 2 + 100)
+        self.write(data)
+        self.assertEqual(self.read(len(data), mmap_threshold=1), data)
+
+    def test_truncated_since_stat(self):
+        # the file was emptied after it was stat'ed, mmap cannot map it
+        self.write(b"")
+        self.assertEqual(self.read(4096, mmap_threshold=1), b"")
+        self.write(b"short")
+        self.assertEqual(self.read(4096, mmap_threshold=1), b"short")
+
+    @unittest.skipUnless(hasattr(os, "O_DIRECT"), "no O_DIRECT")
+    def test_direct_io(self):
+        data = os.urandom(apt_mirror_check.HASH_CHUNK_SIZE + 100)
+        self.write(data)
+        self.assertEqual(self.read(len(data), direct_io=True), data)
+
+    @unittest.skipUnless(hasattr(os, "O_DIRECT"), "no O_DIRECT")
+    def test_direct_io_refused(self):
+        real_open = os.open
+
+        def refuse_direct(path, flags, *args):
+            if flags & os.O_DIRECT:
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+            return real_open(path, flags, *args)
+
+        self.write(b"on tmpfs")
+        with mock.patch.object(apt_mirror_check.os, "open", refuse_direct):
+            self.assertEqual(self.read(8, direct_io=True), b"on tmpfs")
+
+    @unittest.skipUnless(hasattr(os, "O_DIRECT"), "no O_DIRECT")
+    def test_direct_io_closes_on_error(self):
+        self.write(b"data")
+        with mock.patch.object(apt_mirror_check.mmap, "mmap", side_effect=MemoryError), \
+                mock.patch.object(apt_mirror_check.os, "close", wraps=os.close) as os_close:
+            with self.assertRaises(MemoryError):
+                self.read(4, direct_io=True)
+        os_close.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
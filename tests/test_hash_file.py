@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+class SlowLimit(object):
+    """ A read limit which always makes the reader wait """
+
+    def __init__(self, wait):
+        self.wait = wait
+        self.consumed = 0
+
+    def consume(self, amount):
+        self.consumed += amount
+        time.sleep(self.wait)
+
+
+class HashFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a_1.0_amd64.deb")
+        self.data = b"a" * (apt_mirror_check.HASH_CHUNK_SIZE + 10)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+        self.attr = apt_mirror_check.FileAttr(self.path)
+        self.attr.size = len(self.data)
+        self.stats = apt_mirror_check.Stats()
+        self.stats.begin(self.tmp.name, "pool")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def hash_file(self, **kwargs):
+        options = apt_mirror_check.CheckOptions(stats=self.stats, **kwargs)
+        return apt_mirror_check.hash_file(self.path, self.attr, os.stat(self.path), options)
+
+    def test_read_limit_wait_is_not_hashing(self):
+        self.attr.sh256sum = hashlib.sha256(self.data).hexdigest()
+        read_limit = SlowLimit(0.2)
+        self.assertTrue(self.hash_file(read_limit=read_limit))
+        self.assertEqual(read_limit.consumed, len(self.data))
+        self.assertEqual(self.stats.section["bytes_hashed"], len(self.data))
+        self.assertLess(self.stats.section["hashing"], 0.2)
+
+    def test_mismatch(self):
+        self.attr.sh256sum = hashlib.sha256(b"other").hexdigest()
+        self.assertFalse(self.hash_file())
+
+    def test_no_digest_reads_nothing(self):
+        read_limit = SlowLimit(0)
+        self.assertTrue(self.hash_file(read_limit=read_limit))
+        self.assertEqual(read_limit.consumed, 0)
+        self.assertEqual(self.stats.section["bytes_hashed"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
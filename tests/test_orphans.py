@@ -0,0 +1,65 @@
+# coding: utf-8
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+class PathHashSetTest(unittest.TestCase):
+
+    def test_sorted_runs_are_merged_without_duplicates(self):
+        paths = ["pool/main/p/pkg%d/pkg%d_1.0_amd64.deb" % (i % 700, i % 700) for i in range(2000)]
+        with mock.patch.object(apt_mirror_check.PathHashSet, "RUN_SIZE", 64):
+            hashes = apt_mirror_check.PathHashSet(iter(paths))
+        self.assertEqual(len(hashes), 700)
+        self.assertEqual(list(hashes.hashes), sorted(set(map(apt_mirror_check.PathHashSet.hash, paths))))
+        for path in paths:
+            self.assertIn(path, hashes)
+        self.assertNotIn("pool/main/p/pkg700/pkg700_1.0_amd64.deb", hashes)
+
+    def test_empty(self):
+        hashes = apt_mirror_check.PathHashSet([])
+        self.assertEqual(len(hashes), 0)
+        self.assertNotIn("pool/a.deb", hashes)
+
+
+class OrphanFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pool_dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, relpath, size):
+        path = os.path.join(self.pool_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_referenced_paths_are_excluded(self):
+        referenced = ["pool/main/a/a/a_1.0_amd64.deb", "pool/main/b/b/b_1.0_amd64.deb", "dists/focal/Release"]
+        for relpath in referenced:
+            self.write(relpath, 10)
+        orphans = {self.write("pool/main/a/a/a_0.9_amd64.deb", 100): 100,
+                   self.write("pool/main/c/c/c_1.0_amd64.deb", 2000): 2000}
+        # Release files are never orphans, even when no index lists them
+        self.write("pool/main/Release", 5)
+
+        found = list(apt_mirror_check.orphan_files(self.pool_dir, os.path.join(self.pool_dir, "pool"),
+                                                   apt_mirror_check.PathHashSet(referenced)))
+        self.assertTrue(all(bad_file.category == apt_mirror_check.ORPHAN for bad_file in found))
+        self.assertEqual({bad_file.path: bad_file.size for bad_file in found}, orphans)
+        self.assertEqual(sum(bad_file.size for bad_file in found), 2100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+import gzip
+import hashlib
+import lzma
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+def stanza(i, filename=True):
+    data = ("pkg%d" % i).encode()
+    lines = ["Package: pkg%d" % i, "Architecture: amd64", "Version: 1.%d" % i]
+    if filename:
+        lines.append("Filename: pool/main/p/pkg%d/pkg%d_1.%d_amd64.deb" % (i, i, i))
+    lines += ["Size: %d" % (1000 + i),
+              "MD5sum: " + hashlib.md5(data).hexdigest(),
+              "SHA256: " + hashlib.sha256(data).hexdigest(),
+              "SHA512: " + hashlib.sha512(data).hexdigest(),
+              "Description: package %d" % i,
+              " long description of pkg%d," % i,
+              " .",
+              " which spans several lines"]
+    return "\n".join(lines) + "\n"
+
+
+def expected_record(i):
+    data = ("pkg%d" % i).encode()
+    return apt_mirror_check.PkgRecord("pool/main/p/pkg%d/pkg%d_1.%d_amd64.deb" % (i, i, i), 1000 + i,
+                                      hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(),
+                                      hashlib.sha512(data).hexdigest())
+
+
+class PkgRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        data = text.encode()
+        if name.endswith(".gz"):
+            data = gzip.compress(data)
+        elif name.endswith(".xz"):
+            data = lzma.compress(data)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_stanzas_split_across_blocks(self):
+        path = self.write("Packages", "\n".join(stanza(i) for i in range(5)))
+        for block_size in (1, 7, 64, 1024 * 1024):
+            self.assertEqual(list(apt_mirror_check.pkg_records(path, block_size)),
+                             [expected_record(i) for i in range(5)], block_size)
+
+    def test_no_trailing_blank_line(self):
+        path = self.write("Packages", stanza(0) + "\n" + stanza(1).rstrip("\n"))
+        self.assertEqual(list(apt_mirror_check.pkg_records(path, 16)), [expected_record(0), expected_record(1)])
+
+    def test_compressed_variants(self):
+        text = "\n".join(stanza(i) for i in range(3)) + "\n"
+        for name in ("Packages.gz", "Packages.xz"):
+            path = self.write(name, text)
+            self.assertEqual(list(apt_mirror_check.pkg_records(path, 50)), [expected_record(i) for i in range(3)],
+                             name)
+
+    def test_stanza_without_filename(self):
+        path = self.write("Packages", "\n".join((stanza(0), stanza(1, filename=False), stanza(2))))
+        self.assertEqual(list(apt_mirror_check.pkg_records(path)), [expected_record(0), expected_record(2)])
+
+    def test_same_as_pkg_attrs(self):
+        path = self.write("Packages", "\n".join(stanza(i, filename=i % 4 != 3) for i in range(20)) + "\n")
+        from_attrs = [apt_mirror_check.PkgRecord(attrs["Filename"], int(attrs["Size"]), attrs["MD5sum"],
+                                                 attrs["SHA256"], attrs["SHA512"])
+                      for attrs in apt_mirror_check.pkg_attrs(path) if "Filename" in attrs]
+        self.assertEqual(len(from_attrs), 15)
+        self.assertEqual(list(apt_mirror_check.pkg_records(path, 100)), from_attrs)
+
+
+if __name__ == "__main__":
+    unittest.main()
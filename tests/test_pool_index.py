@@ -0,0 +1,54 @@
+# coding: utf-8
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+class PoolIndexTest(unittest.TestCase):
+
+    def test_lookup_and_order(self):
+        index = apt_mirror_check.PoolIndex("/m")
+        for relpath, attr in (("pool/x/b.deb", 1), ("pool/x/a.deb", 2), ("top.deb", 3), ("pool/y/c.deb", 4)):
+            index.add(relpath, attr)
+        self.assertEqual(index["/m/pool/x/b.deb"], 1)
+        self.assertEqual(index["/m/top.deb"], 3)
+        self.assertNotIn("/m/pool/x/c.deb", index)
+        self.assertNotIn("/m/pool/x", index)
+        self.assertNotIn("/other/pool/x/a.deb", index)
+        self.assertEqual(list(index.sorted_items()), [("/m/top.deb", 3), ("/m/pool/x/a.deb", 2),
+                                                      ("/m/pool/x/b.deb", 1), ("/m/pool/y/c.deb", 4)])
+
+    def test_last_add_wins(self):
+        index = apt_mirror_check.PoolIndex("/m")
+        index.add("pool/x/a.deb", 1)
+        index.add("pool/x/a.deb", 2)
+        self.assertEqual(index["/m/pool/x/a.deb"], 2)
+        # adding after a lookup sorts the directory again
+        index.add("pool/x/0.deb", 3)
+        index.add("pool/x/a.deb", 4)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(dict(index.items()), {"/m/pool/x/0.deb": 3, "/m/pool/x/a.deb": 4})
+
+    def test_path_filter(self):
+        index = apt_mirror_check.PoolIndex("/m", lambda path: path.endswith("a.deb"))
+        index.add("pool/x/a.deb", 1)
+        index.add("pool/x/b.deb", 2)
+        self.assertEqual(list(index), ["/m/pool/x/a.deb"])
+
+    def test_large_directory(self):
+        # a flat repository keeps every entry in the same directory
+        index = apt_mirror_check.PoolIndex("/m")
+        names = ["pkg%d_1.0_amd64.deb" % i for i in range(50000)]
+        for i, name in enumerate(reversed(names)):
+            index.add(name, i)
+        self.assertEqual(len(index), len(names))
+        self.assertTrue(all("/m/" + name in index for name in names))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding: utf-8
+
+import errno
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+class QuarantineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sites_dir = os.path.join(self.tmp.name, "mirror")
+        self.run_dir = os.path.join(self.tmp.name, "var", "quarantine", "run")
+        self.paths = [self.write("archive.example.org/ubuntu/pool/main/a/a/a_1.0_amd64.deb", b"corrupted a"),
+                      self.write("archive.example.org/ubuntu/pool/main/b/b/b_1.0_amd64.deb", b"corrupted b")]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, relpath, data):
+        path = os.path.join(self.sites_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def round_trip(self):
+        moved = list(apt_mirror_check.quarantine_files(self.run_dir, self.sites_dir, self.paths, batch_size=1))
+        self.assertEqual(moved, self.paths)
+        for path in self.paths:
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.isfile(os.path.join(self.run_dir, os.path.relpath(path, self.sites_dir))))
+        with open(os.path.join(self.run_dir, apt_mirror_check.QUARANTINE_MANIFEST)) as f:
+            self.assertEqual([json.loads(line)["path"] for line in f],
+                             [os.path.relpath(path, self.sites_dir) for path in self.paths])
+
+        # apt-mirror downloaded b again in the meantime
+        self.write(os.path.relpath(self.paths[1], self.sites_dir), b"good b")
+        restored = list(apt_mirror_check.restore_quarantine(self.run_dir, self.sites_dir))
+        self.assertEqual(restored, [(self.paths[0], True), (self.paths[1], False)])
+        self.assertEqual(self.read(self.paths[0]), b"corrupted a")
+        self.assertEqual(self.read(self.paths[1]), b"good b")
+        # the quarantined copy of b stays, with its manifest
+        self.assertEqual(self.read(os.path.join(self.run_dir, os.path.relpath(self.paths[1], self.sites_dir))),
+                         b"corrupted b")
+        self.assertTrue(os.path.isfile(os.path.join(self.run_dir, apt_mirror_check.QUARANTINE_MANIFEST)))
+
+    def test_round_trip(self):
+        self.round_trip()
+
+    def test_round_trip_across_file_systems(self):
+        def rename(source, target):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        with mock.patch.object(apt_mirror_check.os, "rename", rename):
+            self.round_trip()
+
+    def test_restore_removes_empty_run(self):
+        list(apt_mirror_check.quarantine_files(self.run_dir, self.sites_dir, self.paths))
+        restored = list(apt_mirror_check.restore_quarantine(self.run_dir, self.sites_dir))
+        self.assertEqual(restored, [(path, True) for path in self.paths])
+        self.assertFalse(os.path.exists(self.run_dir))
+
+    def test_new_runs_never_collide(self):
+        quarantine_dir = os.path.dirname(self.run_dir)
+        with mock.patch.object(apt_mirror_check.time, "strftime", return_value="20260101-000000"):
+            runs = [apt_mirror_check.new_quarantine_run(quarantine_dir) for _ in range(3)]
+        self.assertEqual(len(set(runs)), 3)
+        self.assertTrue(all(os.path.isdir(run) for run in runs))
+        self.assertTrue(all(os.path.basename(run).startswith("20260101-000000-") for run in runs))
+        self.assertEqual(sorted(runs), runs)
+
+
+if __name__ == "__main__":
+    unittest.main()
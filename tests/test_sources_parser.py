@@ -0,0 +1,78 @@
+# coding: utf-8
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import apt_mirror_check  # noqa: E402
+
+
+def digests(name):
+    data = name.encode()
+    return hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(), hashlib.sha512(data).hexdigest()
+
+
+def stanza(package, names, directory=True, extra=None):
+    lines = ["Package: %s" % package, "Binary: %s" % package, "Version: 1.0-1"]
+    if directory:
+        lines.append("Directory: pool/main/%s/%s" % (package[0], package))
+    for field, position in (("Files", 0), ("Checksums-Sha256", 1), ("Checksums-Sha512", 2)):
+        lines.append(field + ":")
+        # each field lists the files in its own order, they are joined by name
+        for name in (names if position != 1 else reversed(names)):
+            lines.append(" %s %d %s" % (digests(name)[position], len(name), name))
+        lines += (extra or {}).get(field, [])
+    return "\n".join(lines) + "\n"
+
+
+def expected_record(package, name):
+    return apt_mirror_check.PkgRecord("pool/main/%s/%s/%s" % (package[0], package, name), len(name),
+                                      *digests(name))
+
+
+class SrcRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text):
+        path = os.path.join(self.tmp.name, "Sources")
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_checksum_fields_joined_by_name(self):
+        names = ["hello_1.0-1.dsc", "hello_1.0.orig.tar.gz", "hello_1.0-1.debian.tar.xz"]
+        path = self.write(stanza("hello", names) + "\n" + stanza("libfoo", ["libfoo_1.0-1.dsc"]))
+        for block_size in (16, 1024 * 1024):
+            self.assertEqual(list(apt_mirror_check.src_records(path, block_size)),
+                             [expected_record("hello", name) for name in names] +
+                             [expected_record("libfoo", "libfoo_1.0-1.dsc")], block_size)
+
+    def test_directory_prefix(self):
+        path = self.write(stanza("hello", ["hello_1.0-1.dsc"]))
+        record, = apt_mirror_check.src_records(path)
+        self.assertEqual(record.filename, "pool/main/h/hello/hello_1.0-1.dsc")
+
+    def test_stanza_without_directory(self):
+        path = self.write("\n".join((stanza("a", ["a_1.dsc"]), stanza("b", ["b_1.dsc"], directory=False),
+                                     stanza("c", ["c_1.dsc"]))))
+        self.assertEqual(list(apt_mirror_check.src_records(path)),
+                         [expected_record("a", "a_1.dsc"), expected_record("c", "c_1.dsc")])
+
+    def test_malformed_checksum_lines(self):
+        extra = {"Files": [" d41d8cd98f00b204e9800998ecf8427e 12", " d41d8cd98f00b204e9800998ecf8427e x bad.dsc"],
+                 "Checksums-Sha256": [" 0 1 2 extra.dsc", " e3b0c44298fc1c149afbf4c8996fb924 -5 neg.dsc"]}
+        path = self.write(stanza("hello", ["hello_1.0-1.dsc"], extra=extra))
+        self.assertEqual(list(apt_mirror_check.src_records(path)), [expected_record("hello", "hello_1.0-1.dsc")])
+
+
+if __name__ == "__main__":
+    unittest.main()